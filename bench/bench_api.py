@@ -0,0 +1,298 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Benchmark of the authentication and ticket creation hot paths.
+
+A throwaway Trac environment backed by SQLite is created in a temporary
+directory for each table size, seeded with the requested number of access
+tokens and permission groups. `TicketAPI.process_request` and
+`AccessTokenBackendPlugin.render_preference_panel` are then driven with
+mock requests, reporting the requests/sec and the p50/p99 latencies of
+each scenario.
+
+Ticket creations are also run from `--threads` concurrent threads, with a
+transaction per request and then with group commit.
+
+    python bench/bench_api.py --tokens 100,10000 --groups 10 --requests 500
+"""
+
+import argparse
+import hashlib
+import itertools
+import json
+import shutil
+import tempfile
+import threading
+import time
+
+from StringIO import StringIO
+
+from trac.env import Environment
+from trac.perm import PermissionCache
+from trac.util.datefmt import to_utimestamp, datetime_now, utc
+from trac.web.api import RequestDone
+from trac.web.href import Href
+
+from tracaccesstoken.api import TicketAPI
+from tracaccesstoken.groupcommit import GroupCommit
+from tracaccesstoken.web_ui import AccessTokenBackendPlugin
+
+CREATOR = 'creator'
+VIEWER = 'viewer'
+
+
+class BenchRequest(object):
+    """The subset of `trac.web.api.Request` used by the plugin."""
+
+    def __init__(self, env, method='GET', path_info='/', headers=None,
+                 body='', args=None, authname='anonymous'):
+        self.method = method
+        self.path_info = path_info
+        self.args = args or {}
+        self.query_string = '&'.join('%s=%s' % item
+                                     for item in self.args.iteritems())
+        self.authname = authname
+        self.perm = PermissionCache(env, authname)
+        self.tz = utc
+        self.href = self.abs_href = Href('/trac')
+        self.chrome = {}
+        self.status = None
+        self._headers = dict((k.lower(), v)
+                             for k, v in (headers or {}).iteritems())
+        self._headers.setdefault('content-length', str(len(body)))
+        self._body = StringIO(body)
+        self._response = []
+
+    def get_header(self, name):
+        return self._headers.get(name.lower())
+
+    def read(self, size=None):
+        return self._body.read(size if size is not None else -1)
+
+    def send_response(self, code=200):
+        self.status = code
+
+    def send_header(self, name, value):
+        pass
+
+    def end_headers(self):
+        pass
+
+    def write(self, data):
+        self._response.append(data)
+
+    def send(self, content, content_type='text/html', status=200):
+        self.send_response(status)
+        self.write(content)
+        raise RequestDone
+
+
+def create_environment(path, options):
+    options = [('trac', 'database', 'sqlite:db/trac.db'),
+               ('components', 'tracaccesstoken.*', 'enabled')] + options
+    return Environment(path, create=True, options=options)
+
+
+def seed(env, ntokens, ngroups):
+    """Create `ntokens` tokens, and `ngroups` permission groups for the
+    creator and the viewer. Only the creator gets TICKET_CREATE.
+    """
+    now = to_utimestamp(datetime_now(utc))
+    with env.db_transaction as db:
+        db.executemany("""
+            INSERT INTO kkbox_trac_access_token
+             (username, access_token, description, change_time, create_time)
+            VALUES (%s,%s,%s,%s,%s)
+            """, [(CREATOR if i % 2 else VIEWER,
+                   hashlib.sha224(token_of(i)).hexdigest(),
+                   'bench token %d' % i, now, now)
+                  for i in xrange(ntokens)])
+        perms = []
+        for i in xrange(ngroups):
+            group = 'group%d' % i
+            perms.append((group, 'TICKET_VIEW'))
+            perms.append((CREATOR, group))
+            perms.append((VIEWER, group))
+        perms.append((CREATOR, 'TICKET_CREATE'))
+        db.executemany("INSERT INTO permission (username, action) "
+                       "VALUES (%s,%s)", perms)
+
+
+def token_of(i):
+    return 'bench-token-%d' % i
+
+
+def api_request(env, token, body):
+    return BenchRequest(env, 'POST', '/api/tickets', headers={
+        'Content-Type': 'application/json',
+        'Authorization': 'token %s' % token,
+    }, body=body)
+
+
+def scenarios(env, ntokens):
+    api = TicketAPI(env)
+    prefs = AccessTokenBackendPlugin(env)
+    body = json.dumps({'summary': 'Benchmark ticket'})
+    creator_token = token_of(ntokens - 1 if (ntokens - 1) % 2 else 1)
+    viewer_token = token_of(0)
+
+    def auth_fail():
+        req = api_request(env, 'not-a-token', body)
+        api.process_request(req)
+        return req
+
+    def auth_ok_403():
+        req = api_request(env, viewer_token, body)
+        api.process_request(req)
+        return req
+
+    def create():
+        req = api_request(env, creator_token, body)
+        api.process_request(req)
+        return req
+
+    def prefs_list():
+        req = BenchRequest(env, 'GET', '/prefs/accesstoken',
+                           args={'action': 'GET'}, authname=CREATOR)
+        try:
+            prefs.render_preference_panel(req, 'accesstoken')
+        except RequestDone:
+            pass
+        return req
+
+    return [
+        ('auth-fail', auth_fail, 401),
+        ('auth-ok/403', auth_ok_403, 403),
+        ('create', create, 201),
+        ('prefs-list', prefs_list, 200),
+    ]
+
+
+def concurrent_scenarios(env, ntokens, max_wait, max_size):
+    """Return the concurrent ticket creation scenarios, with the group
+    commit to use for each."""
+    api = TicketAPI(env)
+    body = json.dumps({'summary': 'Benchmark ticket'})
+    creator_token = token_of(ntokens - 1 if (ntokens - 1) % 2 else 1)
+
+    def create():
+        req = api_request(env, creator_token, body)
+        api.process_request(req)
+        return req
+
+    return [
+        ('create-mt', create, 201, None),
+        ('create-mt/gc', create, 201, GroupCommit(env, max_wait, max_size)),
+    ]
+
+
+def run(func, expected, nrequests):
+    latencies = []
+    for _ in xrange(nrequests):
+        start = time.time()
+        req = func()
+        latencies.append(time.time() - start)
+        if expected is not None and req.status != expected:
+            raise AssertionError('Expected status %s, got %s: %s'
+                                 % (expected, req.status,
+                                    ''.join(req._response)))
+    latencies.sort()
+    return (nrequests / sum(latencies),
+            percentile(latencies, 50), percentile(latencies, 99))
+
+
+def run_concurrent(func, expected, nrequests, nthreads):
+    latencies = []
+    failures = []
+    counter = itertools.count()
+
+    def worker():
+        while next(counter) < nrequests:
+            start = time.time()
+            req = func()
+            latencies.append(time.time() - start)
+            if expected is not None and req.status != expected:
+                failures.append(req)
+
+    threads = [threading.Thread(target=worker) for _ in xrange(nthreads)]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - start
+    if failures:
+        req = failures[0]
+        raise AssertionError('Expected status %s, got %s: %s'
+                             % (expected, req.status, ''.join(req._response)))
+    latencies.sort()
+    return (nrequests / elapsed,
+            percentile(latencies, 50), percentile(latencies, 99))
+
+
+def percentile(values, pct):
+    index = int(round(pct / 100.0 * (len(values) - 1)))
+    return values[index]
+
+
+def parse_options(values):
+    options = []
+    for value in values:
+        key, _, option_value = value.partition('=')
+        section, _, name = key.partition('.')
+        options.append((section, name, option_value))
+    return options
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--tokens', default='100,10000',
+                        help='comma separated token table sizes')
+    parser.add_argument('--groups', default='10',
+                        help='comma separated permission group counts')
+    parser.add_argument('--requests', type=int, default=500,
+                        help='requests per scenario')
+    parser.add_argument('--threads', type=int, default=8,
+                        help='threads of the concurrent scenarios')
+    parser.add_argument('--group-commit-wait', type=float, default=0.005,
+                        help='seconds a group commit waits for writes')
+    parser.add_argument('--group-commit-size', type=int, default=50,
+                        help='maximum writes per group commit')
+    parser.add_argument('--option', action='append', default=[],
+                        metavar='SECTION.NAME=VALUE',
+                        help='trac.ini option of the benchmark environment')
+    args = parser.parse_args()
+    options = parse_options(args.option)
+
+    print '%-8s %-8s %-12s %10s %10s %10s' % ('tokens', 'groups', 'scenario',
+                                              'req/s', 'p50 ms', 'p99 ms')
+    for ntokens in [int(n) for n in args.tokens.split(',')]:
+        for ngroups in [int(n) for n in args.groups.split(',')]:
+            path = tempfile.mkdtemp(prefix='tracaccesstoken-bench-')
+            try:
+                env = create_environment(path, options)
+                seed(env, max(ntokens, 2), ngroups)
+                for name, func, expected in scenarios(env, max(ntokens, 2)):
+                    rps, p50, p99 = run(func, expected, args.requests)
+                    print '%-8d %-8d %-12s %10.1f %10.2f %10.2f' % \
+                          (ntokens, ngroups, name, rps, p50 * 1000,
+                           p99 * 1000)
+                api = TicketAPI(env)
+                for name, func, expected, group_commit in \
+                        concurrent_scenarios(env, max(ntokens, 2),
+                                             args.group_commit_wait,
+                                             args.group_commit_size):
+                    api._group_commit = group_commit
+                    rps, p50, p99 = run_concurrent(func, expected,
+                                                   args.requests,
+                                                   args.threads)
+                    print '%-8d %-8d %-12s %10.1f %10.2f %10.2f' % \
+                          (ntokens, ngroups, name, rps, p50 * 1000,
+                           p99 * 1000)
+                env.shutdown()
+            finally:
+                shutil.rmtree(path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Benchmark of the plugin cold start.
+
+Each run starts a fresh Python process, as a CGI request or a `tracd -r`
+reload would, which measures the time taken to import the plugin on top of
+Trac, the modules it pulls in, and the latency of the first ticket
+creation against a throwaway SQLite environment.
+
+    python bench/bench_startup.py --runs 10 --max-import 50
+
+The run fails when the median import time or first request latency exceeds
+`--max-import` or `--max-first-request` milliseconds.
+"""
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+# Trac modules loaded by any request, not counted as the plugin's
+TRAC_MODULES = ('trac.core', 'trac.env', 'trac.perm', 'trac.web.api',
+                'trac.web.main', 'trac.web.chrome', 'trac.ticket.model')
+
+
+def child(path, token):
+    """Measure a cold start, printing the results as JSON."""
+    for name in TRAC_MODULES:
+        __import__(name)
+    before = set(name for name, module in sys.modules.iteritems()
+                 if module is not None)
+    start = time.time()
+    import tracaccesstoken
+    import_time = time.time() - start
+    modules = sorted(name for name, module in sys.modules.iteritems()
+                     if module is not None and name not in before)
+
+    from trac.env import Environment
+    from bench_api import api_request
+    env = Environment(path)
+    req = api_request(env, token, json.dumps({'summary': 'Cold start'}))
+    start = time.time()
+    tracaccesstoken.TicketAPI(env).process_request(req)
+    first_request = time.time() - start
+    if req.status != 201:
+        raise AssertionError('Expected status 201, got %s: %s'
+                             % (req.status, ''.join(req._response)))
+    env.shutdown()
+    print json.dumps({'import': import_time, 'modules': modules,
+                      'first_request': first_request})
+
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--runs', type=int, default=5,
+                        help='cold starts to measure')
+    parser.add_argument('--max-import', type=float, default=0,
+                        help='maximum median import time in ms, 0 for none')
+    parser.add_argument('--max-first-request', type=float, default=0,
+                        help='maximum median first request latency in ms, '
+                             '0 for none')
+    parser.add_argument('--modules', action='store_true',
+                        help='list the modules imported by the plugin')
+    parser.add_argument('--child', nargs=2, metavar=('PATH', 'TOKEN'),
+                        help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        child(*args.child)
+        return
+
+    from bench_api import create_environment, seed, token_of
+    path = tempfile.mkdtemp(prefix='tracaccesstoken-bench-')
+    try:
+        env = create_environment(path, [])
+        seed(env, 2, 1)
+        env.shutdown()
+        results = []
+        for _ in xrange(args.runs):
+            output = subprocess.check_output(
+                [sys.executable, os.path.abspath(__file__),
+                 '--child', path, token_of(1)])
+            results.append(json.loads(output.splitlines()[-1]))
+    finally:
+        shutil.rmtree(path)
+
+    import_time = median(r['import'] for r in results) * 1000
+    first_request = median(r['first_request'] for r in results) * 1000
+    modules = results[-1]['modules']
+    print '%-16s %10s %10s' % ('phase', 'p50 ms', 'max ms')
+    print '%-16s %10.2f %10.2f' % (
+        'plugin import', import_time,
+        max(r['import'] for r in results) * 1000)
+    print '%-16s %10.2f %10.2f' % (
+        'first request', first_request,
+        max(r['first_request'] for r in results) * 1000)
+    print '%d modules imported by the plugin' % len(modules)
+    if args.modules:
+        for name in modules:
+            print '  %s' % name
+
+    failed = False
+    if args.max_import and import_time > args.max_import:
+        print 'Plugin import is slower than %.2f ms' % args.max_import
+        failed = True
+    if args.max_first_request and first_request > args.max_first_request:
+        print 'First request is slower than %.2f ms' % args.max_first_request
+        failed = True
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -3,3 +3,4 @@
 from web_ui import AccessTokenBackendException
 from web_ui import AccessTokenBackendPlugin
 from api import TicketAPI
+from admin import AccessTokenAdmin
@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*-
+
+import json
+import sys
+
+from trac.admin.api import AdminCommandError, IAdminCommandProvider
+from trac.admin.api import get_console_locale
+from trac.core import *
+from trac.perm import PermissionSystem
+from trac.util.datefmt import parse_date, to_utimestamp
+from trac.util.text import printout
+from trac.util.translation import _
+
+from tracaccesstoken.api import TicketAPI
+from tracaccesstoken.db_upgrade import CHUNK_SIZE
+
+__all__ = ['AccessTokenAdmin']
+
+COLUMNS = ('username', 'access_token', 'description', 'change_time',
+           'create_time', 'last_use_time', 'use_count', 'expire_time')
+# Values bound to an IN clause at once, SQLite allows 999 parameters
+IN_CHUNK_SIZE = 500
+
+
+def _chunks(values, size=IN_CHUNK_SIZE):
+    for i in xrange(0, len(values), size):
+        yield values[i:i + size]
+
+
+class AccessTokenAdmin(Component):
+    """trac-admin commands administrating the access tokens in bulk.
+
+    The tokens are deleted, exported and imported in chunks, each chunk in
+    its own short transaction.
+    """
+    implements(IAdminCommandProvider)
+
+    # IAdminCommandProvider methods
+    def get_admin_commands(self):
+        yield ('accesstoken revoke user', '<user> [user] [...]',
+               'Revoke all the access tokens of the users',
+               None, self._do_revoke_user)
+        yield ('accesstoken revoke group', '<group> [group] [...]',
+               'Revoke all the access tokens of the members of the groups',
+               None, self._do_revoke_group)
+        yield ('accesstoken revoke before', '<date>',
+               'Revoke the access tokens created before the date',
+               None, self._do_revoke_before)
+        yield ('accesstoken purge', '<date>',
+               'Delete the access tokens unused since the date',
+               None, self._do_purge)
+        yield ('accesstoken export', '[file]',
+               'Export the access tokens as JSON lines\n\n'
+               'The tokens are written to the standard output when no file '
+               'is given.',
+               None, self._do_export)
+        yield ('accesstoken import', '<file>',
+               'Import the access tokens from a JSON lines file\n\n'
+               'Tokens which already exist are skipped.',
+               None, self._do_import)
+
+    def _do_revoke_user(self, *users):
+        if not users:
+            raise AdminCommandError(_("No user given"))
+        deleted = 0
+        for chunk in _chunks(users):
+            deleted += self._delete_tokens(
+                "username IN (%s)" % ','.join(['%s'] * len(chunk)), chunk)
+        self._report_deleted(_("Revoked %(count)d access tokens",
+                               count=deleted), deleted)
+
+    def _do_revoke_group(self, *groups):
+        if not groups:
+            raise AdminCommandError(_("No group given"))
+        users = set()
+        for group in groups:
+            users |= self._get_group_members(group)
+        if not users:
+            printout(_("No member in %(groups)s", groups=', '.join(groups)))
+            return
+        self._do_revoke_user(*sorted(users))
+
+    def _do_revoke_before(self, date):
+        deleted = self._delete_tokens("create_time<%s",
+                                      (self._parse_date(date),))
+        self._report_deleted(_("Revoked %(count)d access tokens",
+                               count=deleted), deleted)
+
+    def _do_purge(self, date):
+        ts = self._parse_date(date)
+        deleted = self._delete_tokens(
+            "last_use_time<%s OR (last_use_time IS NULL AND create_time<%s)",
+            (ts, ts))
+        self._report_deleted(_("Purged %(count)d access tokens",
+                               count=deleted), deleted)
+
+    def _do_export(self, filename=None):
+        out = open(filename, 'w') if filename else sys.stdout
+        exported = 0
+        try:
+            last_id = 0
+            while True:
+                rows = self.env.db_query("""
+                    SELECT id, %s FROM kkbox_trac_access_token
+                    WHERE id>%%s ORDER BY id LIMIT %d
+                    """ % (','.join(COLUMNS), CHUNK_SIZE), (last_id,))
+                if not rows:
+                    break
+                for row in rows:
+                    out.write(json.dumps(dict(zip(COLUMNS, row[1:]))) + '\n')
+                exported += len(rows)
+                last_id = rows[-1][0]
+        finally:
+            if filename:
+                out.close()
+        if filename:
+            printout(_("Exported %(count)d access tokens", count=exported))
+
+    def _do_import(self, filename):
+        imported = skipped = 0
+        with open(filename) as f:
+            chunk = []
+            for lineno, line in enumerate(f, 1):
+                if not line.strip():
+                    continue
+                try:
+                    token = json.loads(line)
+                    chunk.append(tuple(token.get(c) for c in COLUMNS))
+                except (ValueError, AttributeError), e:
+                    raise AdminCommandError(_("Invalid token at line "
+                                              "%(lineno)d: %(error)s",
+                                              lineno=lineno, error=e))
+                if len(chunk) >= CHUNK_SIZE:
+                    count = self._insert_tokens(chunk)
+                    imported += count
+                    skipped += len(chunk) - count
+                    chunk = []
+            if chunk:
+                count = self._insert_tokens(chunk)
+                imported += count
+                skipped += len(chunk) - count
+        if imported:
+            TicketAPI(self.env).invalidate_token_cache()
+        printout(_("Imported %(count)d access tokens, skipped %(skipped)d "
+                   "existing ones", count=imported, skipped=skipped))
+
+    # Internal methods
+
+    def _delete_tokens(self, where, args):
+        """Delete the tokens matching `where` in chunks, returning the number
+        of deleted tokens."""
+        deleted = 0
+        while True:
+            with self.env.db_transaction as db:
+                ids = [(id_,) for id_, in db("""
+                    SELECT id FROM kkbox_trac_access_token
+                    WHERE %s LIMIT %d
+                    """ % (where, CHUNK_SIZE), args)]
+                if not ids:
+                    break
+                db.executemany("DELETE FROM kkbox_trac_access_token "
+                               "WHERE id=%s", ids)
+            deleted += len(ids)
+        return deleted
+
+    def _report_deleted(self, message, deleted):
+        if deleted:
+            TicketAPI(self.env).invalidate_token_cache()
+        self.log.info(message)
+        printout(message)
+
+    def _insert_tokens(self, rows):
+        """Insert the tokens whose hash is not already known, returning the
+        number of inserted tokens."""
+        hashes = list(set(row[1] for row in rows))
+        with self.env.db_transaction as db:
+            existing = set()
+            for chunk in _chunks(hashes):
+                existing.update(h for h, in db("""
+                    SELECT access_token FROM kkbox_trac_access_token
+                    WHERE access_token IN (%s)
+                    """ % ','.join(['%s'] * len(chunk)), chunk))
+            new_rows = []
+            for row in rows:
+                if row[1] not in existing:
+                    existing.add(row[1])
+                    new_rows.append(row)
+            db.executemany("INSERT INTO kkbox_trac_access_token (%s) "
+                           "VALUES (%s)"
+                           % (','.join(COLUMNS),
+                              ','.join(['%s'] * len(COLUMNS))), new_rows)
+        return len(new_rows)
+
+    def _get_group_members(self, group):
+        """Return the users belonging to `group`, directly or through
+        nested groups."""
+        members = {}
+        for username, action in PermissionSystem(self.env) \
+                                .get_all_permissions():
+            members.setdefault(action, set()).add(username)
+        users = set()
+        seen = set()
+        pending = [group]
+        while pending:
+            subject = pending.pop()
+            if subject in seen:
+                continue
+            seen.add(subject)
+            for member in members.get(subject, ()):
+                if member in members:
+                    pending.append(member)
+                else:
+                    users.add(member)
+        return users
+
+    def _parse_date(self, date):
+        return to_utimestamp(parse_date(date, hint='datetime',
+                                        locale=get_console_locale(self.env)))
@@ -1,41 +1,163 @@
 # -*- coding: utf-8 -*-
 
+import cgi
 import hashlib
 import json
+import math
+import os
 import re
+import threading
+import time
+
+from datetime import datetime
 
 from trac.core import *
 from trac.env import IEnvironmentSetupParticipant
-from trac.db import DatabaseManager
-from trac.ticket.model import Milestone, Ticket
-from trac.ticket.notification import TicketNotifyEmail
-from trac.perm import PermissionSystem
+from trac.resource import Resource
+from trac.ticket.api import TicketSystem
+from trac.ticket.model import Ticket
+from trac.perm import PermissionCache, PermissionSystem
 from trac.perm import IPermissionGroupProvider
+from trac.util import as_bool, as_int
+from trac.util.text import exception_to_unicode
 from trac.util.datefmt import (
-    get_date_format_hint, get_datetime_format_hint, to_utimestamp,
-    user_time, utc, to_datetime
+    to_utimestamp, utc, to_datetime, datetime_now, from_utimestamp
 )
+from trac.web.api import IRequestFilter, arg_list_to_args, parse_arg_list
 from trac.web.main import IRequestHandler
+from tracaccesstoken.constants import CONFIG_FIELD
 from tracaccesstoken.constants import NAME_RPC_TIMESTAMP
+from tracaccesstoken.constants import NAME_TOKEN_GENERATION
+from tracaccesstoken.groupcommit import GroupCommit
+from tracaccesstoken.metrics import Metrics
+from tracaccesstoken.multipart import (
+    MultipartError, PartTooLarge, parse_multipart
+)
+from tracaccesstoken.notification import NotificationQueue
+from tracaccesstoken.ratelimit import RateLimiter
+from tracaccesstoken.readdb import ReadOnlyDatabase
+from tracaccesstoken.util import LRUCache, PeriodicTask
 
 import db_default
+import db_upgrade
 
-__all__ = ['TicketAPI']
+__all__ = ['TicketAPI', 'InvalidTicketFields']
 
 
 NUMBERS_RE = re.compile(r'\d+', re.U)
+TICKET_PATH_RE = re.compile(r'/api/tickets/(\d+)/?$')
+BULK_PATH_RE = re.compile(r'/api/tickets/bulk/?$')
+# Fields which can not be changed by a bulk update, as in Trac's batch
+# modify. Textarea fields are excluded too.
+PROTECTED_FIELDS = ('id', 'time', 'changetime', 'summary', 'reporter',
+                    'description', 'status', 'resolution', 'owner')
+# Columns of the ticket table, but the id
+TICKET_COLUMNS = ('type', 'time', 'changetime', 'component', 'severity',
+                  'priority', 'owner', 'reporter', 'cc', 'version',
+                  'milestone', 'status', 'resolution', 'summary',
+                  'description', 'keywords')
+TIME_COLUMNS = ('time', 'changetime')
+# Query string arguments which are not ticket filters
+QUERY_ARGS = ('cursor', 'limit', 'fields', 'Authorization')
+# Fields set by the API on ticket creation
+CREATE_PROTECTED_FIELDS = ('id', 'time', 'changetime', 'status',
+                           'resolution')
+
+
+class InvalidTicketFields(ValueError):
+    """
+    Raised when the fields of a ticket in a request body are invalid.
+    `errors` maps the field names to the error messages.
+    """
+
+    def __init__(self, errors):
+        ValueError.__init__(self, 'Invalid fields: %s' % ', '.join(
+            '%s (%s)' % item for item in sorted(errors.iteritems())))
+        self.errors = errors
 
 
 class TicketAPI(Component):
     """ An interface to Trac's ticketing system. """
     implements(
         IRequestHandler,
+        IRequestFilter,
         IEnvironmentSetupParticipant,
         # ITemplateProvider,
         # INavigationContributor
     )
     group_providers = ExtensionPoint(IPermissionGroupProvider)
 
+    def __init__(self):
+        self._token_cache = LRUCache(
+            self.config.getint(*CONFIG_FIELD['token_cache_size']),
+            self.config.getint(*CONFIG_FIELD['token_cache_ttl']))
+        self._negative_token_cache = LRUCache(
+            self.config.getint(*CONFIG_FIELD['negative_token_cache_size']),
+            self.config.getint(*CONFIG_FIELD['negative_token_cache_ttl']))
+        self._token_generation = None
+        self._generation_checked = 0
+        # Bumped whenever the token caches are cleared
+        self._token_cache_epoch = 0
+        self._token_cache_lock = threading.Lock()
+        self._perm_cache = LRUCache(
+            self.config.getint(*CONFIG_FIELD['permission_cache_size']),
+            self.config.getint(*CONFIG_FIELD['permission_cache_ttl']))
+        self._notification_queue = NotificationQueue(
+            self.env,
+            workers=self.config.getint(*CONFIG_FIELD['notify_workers']),
+            maxsize=self.config.getint(*CONFIG_FIELD['notify_queue_size']),
+            max_retries=self.config.getint(
+                *CONFIG_FIELD['notify_max_retries']),
+            retry_delay=self.config.getfloat(
+                *CONFIG_FIELD['notify_retry_delay']))
+        self._pending_usage = {}  # {token_hash: [last_use_time, count]}
+        self._usage_requests = 0
+        self._usage_lock = threading.Lock()
+        self._usage_flusher = PeriodicTask(
+            self.config.getint(*CONFIG_FIELD['last_use_flush_interval']),
+            self.flush_token_usage, name='tracaccesstoken-usage',
+            log=self.log)
+        self._token_limiter = RateLimiter(
+            self.config.getfloat(*CONFIG_FIELD['rate_limit_per_token']),
+            self.config.getint(*CONFIG_FIELD['rate_limit_per_token_burst']))
+        self._user_limiter = RateLimiter(
+            self.config.getfloat(*CONFIG_FIELD['rate_limit_per_user']),
+            self.config.getint(*CONFIG_FIELD['rate_limit_per_user_burst']))
+        max_concurrent = self.config.getint(
+            *CONFIG_FIELD['max_concurrent_requests'])
+        self._concurrency = threading.BoundedSemaphore(max_concurrent) \
+                            if max_concurrent > 0 else None
+        self.metrics = Metrics()
+        self._sweeper = PeriodicTask(
+            self.config.getint(*CONFIG_FIELD['expired_token_sweep_interval']),
+            self.sweep_expired_tokens, name='tracaccesstoken-sweeper',
+            log=self.log)
+        self._idempotency_sweeper = PeriodicTask(
+            self.config.getint(*CONFIG_FIELD['idempotency_sweep_interval']),
+            self.sweep_idempotency_keys,
+            name='tracaccesstoken-idempotency-sweeper', log=self.log)
+        self._field_schema = None
+        self._field_schema_source = None
+        group_commit_max_wait = self.config.getfloat(
+            *CONFIG_FIELD['group_commit_max_wait'])
+        self._group_commit = GroupCommit(
+            self.env, group_commit_max_wait,
+            self.config.getint(*CONFIG_FIELD['group_commit_max_size'])) \
+            if group_commit_max_wait > 0 else None
+        self._group_commit_keys = set()
+        self._group_commit_keys_lock = threading.Lock()
+        read_database = self.config.get(*CONFIG_FIELD['read_database'])
+        self._read_db = ReadOnlyDatabase(
+            self.env, read_database,
+            self.config.getint(*CONFIG_FIELD['read_database_pool_size']),
+            self.config.getfloat(*CONFIG_FIELD['read_database_timeout'])) \
+            if read_database else None
+        self._idempotency_window = self.config.getint(
+            *CONFIG_FIELD['idempotency_window'])
+        self._idempotency_cache = LRUCache(
+            self.config.getint(*CONFIG_FIELD['idempotency_cache_size']),
+            self._idempotency_window)
+
     # IEnvironmentSetupParticipant methods
     def environment_created(self):
         self.found_db_version = 0
@@ -57,159 +179,1393 @@ class TicketAPI(Component):
         return False
 
     def upgrade_environment(self, db):
-        db_manager, _ = DatabaseManager(self.env)._get_connector()
-
-        # update the version
-        old_data = {}  # {table.name: (cols, rows)}
+        start = time.time()
         cursor = db.cursor()
         if not self.found_db_version:
+            db_upgrade.create_tables(self.env, db)
             cursor.execute("INSERT INTO system (name, value) VALUES (%s, %s)",
                            (db_default.name, db_default.version))
         else:
+            if self.found_db_version < db_upgrade.REBUILD_VERSION:
+                db_upgrade.rebuild_tables(self.env, db)
+            else:
+                for version in xrange(self.found_db_version + 1,
+                                      db_default.version + 1):
+                    self.log.info("Upgrading %s to version %d",
+                                  db_default.name, version)
+                    getattr(db_upgrade, 'do_upgrade_%d' % version)(self.env,
+                                                                   db)
             cursor.execute("UPDATE system SET value=%s WHERE name=%s",
                            (db_default.version, db_default.name))
-            for table in db_default.tables:
-                cursor.execute("SELECT * FROM " + table.name)
-                cols = [x[0] for x in cursor.description]
-                rows = cursor.fetchall()
-                old_data[table.name] = (cols, rows)
-                cursor.execute("DROP TABLE " + table.name)
-
-        # insert the default table
-        for table in db_default.tables:
-            for sql in db_manager.to_sql(table):
-                cursor.execute(sql)
-
-            # add old data
-            if table.name in old_data:
-                cols, rows = old_data[table.name]
-                sql = 'INSERT INTO %s (%s) VALUES (%s)' % \
-                      (table.name, ','.join(cols), ','.join(['%s'] * len(cols)))
-                for row in rows:
-                    cursor.execute(sql, row)
+        self.log.info("Upgraded %s from version %d to %d in %.3f seconds",
+                      db_default.name, self.found_db_version,
+                      db_default.version, time.time() - start)
+        self.found_db_version = db_default.version
 
     # IRequestHandler methods
     def match_request(self, req):
-        return '/api/tickets' in req.path_info
+        return '/api/tickets' in req.path_info or \
+               req.path_info == '/api/metrics'
 
     def process_request(self, req):
-        self._process_new_ticket_request(req)
+        if req.path_info == '/api/metrics':
+            self._process_metrics_request(req)
+            return
+        if self._concurrency and not self._concurrency.acquire(False):
+            content = {
+                'message': 'service_unavailable',
+                'description': 'Too many concurrent API requests'
+            }
+            self._send_json(req, 503, content, headers={'Retry-After': 1})
+            return
+        start = time.time()
+        req._access_token_timings = timings = {}
+        try:
+            with self.metrics.timer('request'):
+                match = TICKET_PATH_RE.search(req.path_info)
+                if req.method == 'GET' and match:
+                    self._process_get_ticket_request(req,
+                                                     int(match.group(1)))
+                elif req.method == 'GET':
+                    self._process_query_request(req)
+                elif req.method == 'PATCH' or \
+                        (req.method == 'POST' and
+                         BULK_PATH_RE.search(req.path_info)):
+                    self._process_bulk_update_request(req)
+                else:
+                    self._process_new_ticket_request(req)
+        finally:
+            if self._concurrency:
+                self._concurrency.release()
+            self._log_slow_request(req, time.time() - start, timings)
+
+    # IRequestFilter methods
+    def pre_process_request(self, req, handler):
+        """Keep Trac from parsing the multipart bodies sent to the API, they
+        are streamed by `_process_multipart_request`.
+
+        The access token stands for the form token of the CSRF check, as the
+        API clients have no session cookie.
+        """
+        if handler is self and req.method == 'POST' and \
+                self._is_multipart(req):
+            arg_list = parse_arg_list(req.query_string)
+            if dict(arg_list).get('Authorization') or \
+                    req.get_header('Authorization'):
+                arg_list.append(('__FORM_TOKEN', req.form_token))
+                req.arg_list = arg_list
+                req.args = arg_list_to_args(arg_list)
+        return handler
+
+    def post_process_request(self, req, template, data, content_type):
+        return template, data, content_type
+
+    # Public methods
+
+    def invalidate_token_cache(self):
+        """Drop the cached token owners and rejected tokens, in this process
+        and in the other processes serving the environment.
+
+        Must be called after the token table has been changed.
+        """
+        with self.env.db_transaction as db:
+            generation = None
+            for value, in db("SELECT value FROM system WHERE name=%s",
+                             (NAME_TOKEN_GENERATION,)):
+                generation = int(value) + 1
+                db("UPDATE system SET value=%s WHERE name=%s",
+                   (generation, NAME_TOKEN_GENERATION))
+            if generation is None:
+                generation = 1
+                db("INSERT INTO system (name, value) VALUES (%s, %s)",
+                   (NAME_TOKEN_GENERATION, generation))
+        self._clear_token_caches()
+        self._token_generation = generation
+
+    def forget_rejected_token(self, token_hash):
+        """Drop the hashed token from the cache of rejected tokens, once it
+        has been created. The cached owners are left alone, a new token can
+        not be among them.
+        """
+        with self._token_cache_lock:
+            self._token_cache_epoch += 1
+            self._negative_token_cache.discard(token_hash)
+
+    def token_cache_stats(self):
+        """Return the size and hit/miss counters of the token cache."""
+        return self._token_cache.stats()
+
+    def negative_token_cache_stats(self):
+        """Return the size and hit/miss counters of the cache of rejected
+        tokens."""
+        return self._negative_token_cache.stats()
+
+    def flush_token_usage(self):
+        """Write the recorded token uses to the token table, in a single
+        batch of UPDATEs.
+        """
+        with self._usage_lock:
+            pending, self._pending_usage = self._pending_usage, {}
+            self._usage_requests = 0
+        if not pending:
+            return
+        try:
+            with self.env.db_transaction as db:
+                db.executemany("""
+                    UPDATE kkbox_trac_access_token
+                    SET last_use_time=%s,
+                        use_count=COALESCE(use_count, 0) + %s
+                    WHERE access_token=%s
+                    """, [(last_use, count, token_hash)
+                          for token_hash, (last_use, count)
+                          in pending.iteritems()])
+        except Exception, e:
+            self.log.error("Failed to flush the use of %d access tokens: %s",
+                           len(pending), exception_to_unicode(e))
+            with self._usage_lock:
+                for token_hash, (last_use, count) in pending.iteritems():
+                    self._add_token_use(token_hash, last_use, count)
+        else:
+            self.log.debug("Flushed the use of %d access tokens",
+                           len(pending))
+
+    def sweep_expired_tokens(self):
+        """Delete the expired tokens, `expired_token_sweep_batch` tokens per
+        transaction.
+        """
+        batch = max(1, self.config.getint(
+            *CONFIG_FIELD['expired_token_sweep_batch']))
+        now = to_utimestamp(datetime_now(utc))
+        deleted = 0
+        while True:
+            with self.env.db_transaction as db:
+                ids = [(id_,) for id_, in db("""
+                    SELECT id FROM kkbox_trac_access_token
+                    WHERE expire_time<%%s LIMIT %d
+                    """ % batch, (now,))]
+                if not ids:
+                    break
+                db.executemany("DELETE FROM kkbox_trac_access_token "
+                               "WHERE id=%s", ids)
+            deleted += len(ids)
+        if deleted:
+            self.log.info("Deleted %d expired access tokens", deleted)
+        return deleted
+
+    def sweep_idempotency_keys(self):
+        """Forget the responses stored for the idempotency keys older than
+        `idempotency_window` seconds.
+        """
+        oldest = to_utimestamp(datetime_now(utc)) - \
+                 self._idempotency_window * 1000000
+        with self.env.db_transaction as db:
+            db("""DELETE FROM kkbox_trac_access_token_idempotency
+                  WHERE create_time<%s""", (oldest,))
+
+    def notification_stats(self):
+        """Return the depth and the counters of the notification queue."""
+        return self._notification_queue.stats()
+
+    def group_commit_stats(self):
+        """Return the counters of the group commit of ticket inserts, or
+        an empty dict when it is disabled."""
+        if self._group_commit is None:
+            return {}
+        return self._group_commit.stats()
+
+    def read_query(self, sql, args=()):
+        """Return the rows of a read-only query, run on the `read_database`
+        when configured, else on the main database.
+
+        The read database may lag behind the main one.
+        """
+        if self._read_db is None:
+            return self.env.db_query(sql, args)
+        return self._read_db.query(sql, args)
+
+    def read_database_stats(self):
+        """Return the query counters of the read database, or an empty dict
+        when there is none."""
+        if self._read_db is None:
+            return {}
+        return self._read_db.stats()
 
     # Internal methods
 
+    def _timer(self, req, phase):
+        return self.metrics.timer(phase,
+                                  getattr(req, '_access_token_timings', None))
+
+    def _log_slow_request(self, req, elapsed, timings):
+        threshold = self.config.getint(
+            *CONFIG_FIELD['slow_request_threshold'])
+        if 0 < threshold <= elapsed * 1000:
+            self.log.warn("Slow API request %s %s took %.0f ms (%s)",
+                          req.method, req.path_info, elapsed * 1000,
+                          ', '.join('%s: %.0f ms' % (phase, t * 1000)
+                                    for phase, t in sorted(
+                                        timings.iteritems())))
+
+    def _process_metrics_request(self, req):
+        content_type = 'application/json'
+        if self._authorization(req):
+            username = self._authenticate(req, content_type)
+            if not username:
+                return
+            allowed = 'TRAC_ADMIN' in self._get_groups(username, req)
+        else:
+            username = req.authname
+            allowed = 'TRAC_ADMIN' in req.perm
+        if not allowed:
+            self._send_forbidden(req, 'TRAC_ADMIN', username, content_type)
+            return
+
+        extra = []
+        for name, stats in (('token_cache', self.token_cache_stats()),
+                            ('negative_token_cache',
+                             self.negative_token_cache_stats())):
+            for key, value in sorted(stats.iteritems()):
+                type_ = 'counter' if key in ('hits', 'misses') else 'gauge'
+                suffix = '_total' if type_ == 'counter' else ''
+                extra.append(('%s_%s%s' % (name, key, suffix), type_,
+                              '%s %s.' % (name.replace('_', ' ').capitalize(),
+                                          key), value))
+        for key, value in sorted(self.notification_stats().iteritems()):
+            type_ = 'gauge' if key == 'depth' else 'counter'
+            suffix = '_total' if type_ == 'counter' else ''
+            extra.append(('notification_%s%s' % (key, suffix), type_,
+                          'Notifications %s.' % key, value))
+        for key, value in sorted(self.group_commit_stats().iteritems()):
+            extra.append(('group_commit_%s_total' % key, 'counter',
+                          'Group commit %s.' % key, value))
+        for key, value in sorted(self.read_database_stats().iteritems()):
+            extra.append(('read_database_%s_total' % key, 'counter',
+                          'Read database %s.' % key, value))
+        body = self.metrics.render(extra)
+        req.send_response(200)
+        req.send_header('Content-Type', 'text/plain; version=0.0.4')
+        req.send_header('Content-Length', len(body))
+        req.end_headers()
+        req.write(body)
+
     @staticmethod
     def _authorization(req):
         return req.args.get('Authorization') or req.get_header('Authorization')
 
+    def _check_token_generation(self):
+        """Clear the token cache when another process changed the token
+        table. The generation is read at most once per
+        `token_cache_check_interval` seconds.
+        """
+        now = time.time()
+        interval = self.config.getint(
+            *CONFIG_FIELD['token_cache_check_interval'])
+        if now - self._generation_checked < interval:
+            return
+        self._generation_checked = now
+        generation = 0
+        for value, in self.env.db_query(
+                "SELECT value FROM system WHERE name=%s",
+                (NAME_TOKEN_GENERATION,)):
+            generation = int(value)
+        if generation != self._token_generation:
+            if self._token_generation is not None:
+                self.log.debug("Access token generation changed from %s "
+                               "to %s, clearing token cache",
+                               self._token_generation, generation)
+                self._clear_token_caches()
+            self._token_generation = generation
+
+    def _clear_token_caches(self):
+        with self._token_cache_lock:
+            self._token_cache_epoch += 1
+            self._token_cache.clear()
+            self._negative_token_cache.clear()
+
+    def _get_idempotent_response(self, idempotency):
+        """Return the `(status, content)` stored for the `(token_hash,
+        key)` idempotency key, or `None`.
+        """
+        self._idempotency_sweeper.start()
+        stored = self._idempotency_cache.get(idempotency)
+        if stored is None:
+            oldest = to_utimestamp(datetime_now(utc)) - \
+                     self._idempotency_window * 1000000
+            for status, response in self.env.db_query("""
+                    SELECT status, response
+                    FROM kkbox_trac_access_token_idempotency
+                    WHERE access_token=%s AND idempotency_key=%s
+                     AND create_time>=%s
+                    """, idempotency + (oldest,)):
+                stored = (status, json.loads(response))
+                self._idempotency_cache.set(idempotency, stored)
+        return stored
+
+    def _store_idempotent_response(self, idempotency, status, content,
+                                   db=None):
+        """Store the response to the request with the `(token_hash, key)`
+        idempotency key. When the `db` transaction is given, the caller
+        must cache the response once the transaction is committed.
+
+        A row left for the key by a request older than
+        `idempotency_window` seconds, not swept yet, is replaced.
+        """
+        def do_store(db):
+            now = to_utimestamp(datetime_now(utc))
+            oldest = now - self._idempotency_window * 1000000
+            db("""
+                DELETE FROM kkbox_trac_access_token_idempotency
+                WHERE access_token=%s AND idempotency_key=%s
+                 AND create_time<%s
+                """, idempotency + (oldest,))
+            db("""
+                INSERT INTO kkbox_trac_access_token_idempotency
+                 (access_token, idempotency_key, status, response,
+                  create_time)
+                VALUES (%s,%s,%s,%s,%s)
+                """, idempotency + (status, json.dumps(content), now))
+        if db is not None:
+            do_store(db)
+            return
+        try:
+            with self.env.db_transaction as db:
+                do_store(db)
+        except Exception, e:
+            self.log.warn("Failed to store the response for the "
+                          "idempotency key %s: %s", idempotency[1],
+                          exception_to_unicode(e))
+        else:
+            self._idempotency_cache.set(idempotency, (status, content))
+
+    def _record_token_use(self, token_hash):
+        """Remember the use of the token, to be written by the next
+        `flush_token_usage()`.
+
+        The uses are flushed every `last_use_flush_interval` seconds, or
+        once `last_use_flush_threshold` requests have been recorded.
+        """
+        threshold = self.config.getint(
+            *CONFIG_FIELD['last_use_flush_threshold'])
+        with self._usage_lock:
+            self._add_token_use(token_hash,
+                                to_utimestamp(datetime_now(utc)), 1)
+            self._usage_requests += 1
+            flush = 0 < threshold <= self._usage_requests
+        self._usage_flusher.start()
+        if flush:
+            self.flush_token_usage()
+
+    def _add_token_use(self, token_hash, last_use, count):
+        entry = self._pending_usage.get(token_hash)
+        if entry is None:
+            self._pending_usage[token_hash] = [last_use, count]
+        else:
+            entry[0] = max(entry[0], last_use)
+            entry[1] += count
+
+    def _lookup_token(self, token_hash):
+        """Return the owner of the hashed access token, or `None` when the
+        token is unknown or expired.
+
+        Owners are served from the token cache, otherwise the lookup is a
+        single-row probe of the unique `access_token` index, which also
+        returns the expiry time. Unknown tokens are remembered in the
+        negative token cache, rejecting them again without any query.
+        """
+        self._check_token_generation()
+        self._sweeper.start()
+        entry = self._token_cache.get(token_hash)
+        if entry is None:
+            if self._negative_token_cache.get(token_hash):
+                return None
+            epoch = self._token_cache_epoch
+            entry, cacheable = self._query_token(token_hash)
+            with self._token_cache_lock:
+                # The caches were cleared during the query, the result may
+                # predate the change
+                if cacheable and epoch == self._token_cache_epoch:
+                    if entry:
+                        self._token_cache.set(token_hash, entry)
+                    else:
+                        self._negative_token_cache.set(token_hash, True)
+            self.log.debug("Token cache miss: %s", self.token_cache_stats())
+        if not entry:
+            return None
+        username, expire_time = entry
+        if expire_time and expire_time <= to_utimestamp(datetime_now(utc)):
+            self.log.debug("Access token of %s expired", username)
+            return None
+        return username
+
+    def _query_token(self, token_hash):
+        """Return the owner and expiry time of the token, or `None`, and
+        whether the result can be cached.
+
+        The token is looked up on the read database first. Its rows may lag
+        behind a revocation, so they are not cached. A token missing there
+        is looked up again on the main database, the replica may not have
+        caught up with its creation yet: unknown tokens then cost two
+        queries, until they are remembered as rejected.
+        """
+        sql = """
+            SELECT username, expire_time
+            FROM kkbox_trac_access_token
+            WHERE access_token=%s
+            """
+        if self._read_db is not None:
+            for username, expire_time in self._read_db.query(sql,
+                                                             (token_hash,)):
+                return (username, expire_time), False
+        for username, expire_time in self.env.db_query(sql, (token_hash,)):
+            return (username, expire_time), True
+        return None, True
+
+    def _send_json(self, req, status, content, content_type='application/json',
+                   headers=None):
+        self.metrics.count_status(status)
+        with self._timer(req, 'response'):
+            body = json.dumps(content)
+        req.send_response(status)
+        req.send_header('Content-Type', content_type)
+        req.send_header('Content-Length', len(body))
+        for name, value in (headers or {}).iteritems():
+            req.send_header(name, value)
+        req.end_headers()
+        req.write(body)
+
+    def _send_forbidden(self, req, action, username,
+                        content_type='application/json'):
+        content = {
+            'message': 'forbidden',
+            'description': "%s privileges are required to perform this "
+                           "operation for %s. You don't have the required "
+                           "permissions." % (action, username)
+        }
+        self._send_json(req, 403, content, content_type)
+
+    def _authenticate(self, req, content_type):
+        """Return the owner of the request access token. `None` is returned
+        once an error response has been sent.
+        """
+        authorization = self._authorization(req)
+        if not authorization:
+            content = {
+                'message': 'Empty credentials',
+                'description': "The access token is incorrect."
+            }
+            self._send_json(req, 401, content, content_type)
+            return None
+
+        access_token = str(authorization).replace('token ', '').strip()
+        token_hash = hashlib.sha224(access_token).hexdigest()
+        if self._rate_limited(req, self._token_limiter, token_hash,
+                              content_type):
+            return None
+        with self._timer(req, 'token_lookup'):
+            username = self._lookup_token(token_hash)
+        if not username:
+            content = {
+                'message': 'Bad credentials',
+                'description': "The access token is incorrect."
+            }
+            self._send_json(req, 401, content, content_type)
+            return None
+        if self._rate_limited(req, self._user_limiter, username,
+                              content_type):
+            return None
+        self._record_token_use(token_hash)
+        req._access_token_hash = token_hash
+        return username
+
     def _process_new_ticket_request(self, req):
         if req.method == 'POST':
             content_type = req.get_header('Content-Type') or 'application/json'
+            multipart = self._is_multipart(req)
+            if multipart:
+                content_type = 'application/json'
 
-            authorization = self._authorization(req)
-            if not authorization:
-                content = {
-                    'message': 'Empty credentials',
-                    'description': "The access token is incorrect."
-                }
-                req.send_response(401)
-                req.send_header('Content-Type', content_type)
-                req.send_header('Content-Length', len(json.dumps(content)))
-                req.end_headers()
-                req.write(json.dumps(content))
+            username = self._authenticate(req, content_type)
+            if not username:
                 return
-            else:
-                access_token = str(authorization).replace('token ', '').strip()
-                username = ''
-                for username in self.env.db_query("""
-                    SELECT username
-                    FROM kkbox_trac_access_token
-                    WHERE access_token=%s
-                    ORDER BY create_time DESC
-                    """, (hashlib.sha224(access_token).hexdigest(),)):
-                    username = username[0]
-                if not username:
-                    content = {
-                        'message': 'Bad credentials',
-                        'description': "The access token is incorrect."
-                    }
-                    req.send_response(401)
-                    req.send_header('Content-Type', content_type)
-                    req.send_header('Content-Length', len(json.dumps(content)))
-                    req.end_headers()
-                    req.write(json.dumps(content))
+
+            idempotency = None
+            key = req.get_header('Idempotency-Key')
+            if key:
+                idempotency = (req._access_token_hash, key)
+                if self._replay_idempotent_response(req, idempotency,
+                                                    content_type):
                     return
 
-            allow_create_ticket = 'TICKET_CREATE' in self._get_groups(username)
+            allow_create_ticket = 'TICKET_CREATE' in self._get_groups(username, req)
             if not allow_create_ticket:
+                self._send_forbidden(req, 'TICKET_CREATE', username,
+                                     content_type)
+                return
+
+            if multipart:
+                self._process_multipart_request(req, username, idempotency)
+                return
+
+            if cgi.parse_header(content_type)[0] == 'application/x-ndjson':
+                self._process_ndjson_request(req, username)
+                return
+
+            # Checked before reading, a whole batch is held in memory
+            max_body_size = self.config.getint(
+                *CONFIG_FIELD['max_body_size'])
+            if max_body_size > 0 and \
+                    as_int(req.get_header('Content-Length'), 0) > \
+                    max_body_size:
                 content = {
-                    'message': 'forbidden',
-                    'description': "%s privileges are required to perform this operation for %s. "
-                                   "You don't have the required permissions." % ('TICKET_CREATE', username)
+                    'message': 'body_too_large',
+                    'description': 'The request body exceeds %d bytes'
+                                   % max_body_size
                 }
-                req.send_response(403)
-                req.send_header('Content-Type', content_type)
-                req.send_header('Content-Length', len(json.dumps(content)))
-                req.end_headers()
-                req.write(json.dumps(content))
+                self._send_json(req, 413, content, content_type)
                 return
 
             try:
-                ticket_id = self._create(req, username)
+                post_body = self._read_json(req)
+            except ValueError as ex:
+                self.log.error('_read_json() failed. %s', ex)
+                content = {
+                    'message': 'invalid_json_value',
+                    'description': 'Invalid request body'
+                }
+                self._send_json(req, 400, content, content_type)
+                return
+
+            if isinstance(post_body, list):
+                self._process_batch_request(req, username, post_body,
+                                            content_type, idempotency)
+                return
+
+            try:
+                ticket_id = self._create(req, username, post_body,
+                                         idempotency)
                 content = {
                     'ticket_id': ticket_id
                 }
-                req.send_response(201)
+                status = 201
+            except InvalidTicketFields as ex:
+                self.log.info('_create() rejected invalid fields. %s', ex)
+                content = self._item_error(ex)
+                status = 400
             except ValueError as ex:
                 self.log.error('_create() failed. %s', ex)
                 content = {
                     'message': 'invalid_json_value',
                     'description': 'Invalid request body'
                 }
-                req.send_response(400)
+                status = 400
             except Exception as ex:
+                # A concurrent request with the same key may have won
+                if idempotency and self._replay_idempotent_response(
+                        req, idempotency, content_type):
+                    return
                 self.log.error('_create() failed. %s', ex)
                 content = {
                     'message': 'invalid_json_value',
                     'description': 'Invalid request body'
                 }
-                req.send_response(400)
+                status = 400
+                # May be transient (locked database, ...), let it be retried
+                idempotency = None
+            if idempotency and status != 201:
+                self._store_idempotent_response(idempotency, status, content)
 
             # Build response
-            req.send_header('Content-Type', content_type)
-            req.send_header('Content-Length', len(json.dumps(content)))
-            req.end_headers()
-            req.write(json.dumps(content))
+            self._send_json(req, status, content, content_type)
             return
         else:
             pass
 
-    def _create(self, req, authname_):
-        """ Create a new ticket, returning the ticket ID.
-        Overriding 'when' requires admin permission. """
+    def _replay_idempotent_response(self, req, idempotency, content_type):
+        """Send the response stored for the idempotency key, returning
+        `False` when there is none."""
+        stored = self._get_idempotent_response(idempotency)
+        if stored is None:
+            return False
+        status, content = stored
+        self.log.debug("Replaying the response for the idempotency key %s",
+                       idempotency[1])
+        self._send_json(req, status, content, content_type,
+                        headers={'Idempotent-Replayed': 'true'})
+        return True
+
+    def _process_get_ticket_request(self, req, ticket_id):
+        """Send the ticket fields as JSON, with an ETag derived from the
+        ticket change time. A matching `If-None-Match` gets a 304 without
+        the ticket being loaded.
+        """
+        content_type = 'application/json'
+        username = self._authenticate(req, content_type)
+        if not username:
+            return
+
+        resource = Resource('ticket', ticket_id)
+        if not PermissionCache(self.env, username).has_permission(
+                'TICKET_VIEW', resource):
+            self._send_forbidden(req, 'TICKET_VIEW', username, content_type)
+            return
+
+        changetime = None
+        for changetime, in self.env.db_query(
+                "SELECT changetime FROM ticket WHERE id=%s", (ticket_id,)):
+            pass
+        if changetime is None:
+            content = {
+                'message': 'not_found',
+                'description': 'Ticket #%d does not exist' % ticket_id
+            }
+            self._send_json(req, 404, content, content_type)
+            return
+
+        etag = '"%d-%s"' % (ticket_id, changetime)
+        if_none_match = req.get_header('If-None-Match')
+        if if_none_match and \
+                (if_none_match.strip() == '*' or
+                 etag in [v.strip() for v in if_none_match.split(',')]):
+            self.metrics.count_status(304)
+            req.send_response(304)
+            req.send_header('ETag', etag)
+            req.end_headers()
+            return
+
+        with self._timer(req, 'ticket_load'):
+            t = Ticket(self.env, ticket_id)
+        self._send_json(req, 200, self._ticket_to_json(t), content_type,
+                        headers={'ETag': etag})
+
+    def _process_bulk_update_request(self, req):
+        """Apply the same field changes and comment to a list of tickets,
+        in a single transaction, sending back a result per ticket.
+
+        The request body is `{"ids": [...], "changes": {...},
+        "comment": "...", "notify": false}`.
+        """
+        content_type = 'application/json'
+        username = self._authenticate(req, content_type)
+        if not username:
+            return
+
+        if 'TICKET_BATCH_MODIFY' not in self._get_groups(username, req):
+            self._send_forbidden(req, 'TICKET_BATCH_MODIFY', username,
+                                 content_type)
+            return
+
+        try:
+            post_body = self._read_json(req)
+            ids = post_body.get('ids')
+            changes = post_body.get('changes') or {}
+            comment = post_body.get('comment') or ''
+            notify = as_bool(post_body.get('notify', False))
+            if not isinstance(ids, list) or not ids:
+                raise ValueError('Invalid field. Field name = ids')
+            ids = [int(id_) for id_ in ids]
+            if not isinstance(changes, dict):
+                raise ValueError('Invalid field. Field name = changes')
+            schema = self._get_field_schema()
+            protected = PROTECTED_FIELDS + tuple(
+                name for name, field in schema.iteritems()
+                if field['type'] == 'textarea')
+            changes = self._validate_fields(changes, protected)
+        except InvalidTicketFields as ex:
+            self.log.info('_process_bulk_update_request() rejected invalid '
+                          'fields. %s', ex)
+            self._send_json(req, 400, self._item_error(ex), content_type)
+            return
+        except (ValueError, TypeError, AttributeError) as ex:
+            self.log.error('_process_bulk_update_request() failed. %s', ex)
+            content = {
+                'message': 'invalid_json_value',
+                'description': 'Invalid request body: %s'
+                               % exception_to_unicode(ex)
+            }
+            self._send_json(req, 400, content, content_type)
+            return
+
+        max_size = self.config.getint(*CONFIG_FIELD['batch_max_size'])
+        if len(ids) > max_size:
+            content = {
+                'message': 'batch_too_large',
+                'description': 'At most %d tickets can be updated at once'
+                               % max_size
+            }
+            self._send_json(req, 413, content, content_type)
+            return
+
+        results = self._update_batch(req, username, ids, changes, comment,
+                                     notify)
+        failed = len([r for r in results if not r.get('updated')])
+        if not failed:
+            status = 200
+        elif failed < len(results):
+            status = 207
+        else:
+            status = 400
+        self._send_json(req, status, {'tickets': results}, content_type)
+
+    def _update_batch(self, req, authname_, ids, changes, comment, notify):
+        """Save the changes of the tickets in a single transaction,
+        returning a result per ticket. Should a save fail, the transaction
+        is rolled back and the tickets are saved one transaction at a
+        time, the `ticket_changed` listeners having already run for the
+        rolled back changes."""
+        when = to_datetime(None, utc)
+
+        def load(id_):
+            t = Ticket(self.env, id_)
+            for name, value in changes.iteritems():
+                t[name] = value
+            return t
+
+        results = []
+        tickets = []
+        for id_ in ids:
+            try:
+                tickets.append(load(id_))
+                results.append({'ticket_id': id_, 'updated': True})
+            except Exception as ex:
+                results.append({
+                    'ticket_id': id_,
+                    'message': 'not_found',
+                    'description': exception_to_unicode(ex)
+                })
+
+        try:
+            with self._timer(req, 'ticket_update'), self.env.db_transaction:
+                for t in tickets:
+                    t.save_changes(authname_, comment, when)
+        except Exception as ex:
+            self.log.warn('Bulk update failed, saving the tickets one by '
+                          'one. %s', ex)
+            saved = []
+            for result in results:
+                if not result.get('updated'):
+                    continue
+                try:
+                    with self.env.db_transaction:
+                        t = load(result['ticket_id'])
+                        t.save_changes(authname_, comment, when)
+                    saved.append(t)
+                except Exception as ex:
+                    self.log.error('save_changes() failed. %s', ex)
+                    del result['updated']
+                    result['message'] = 'update_failed'
+                    result['description'] = exception_to_unicode(ex)
+            tickets = saved
+        if notify:
+            for t in tickets:
+                self._notification_queue.enqueue(t.id, newticket=False,
+                                                 modtime=when)
+        return results
+
+    def _process_query_request(self, req):
+        """Stream the tickets matching the query string filters as JSON,
+        in ascending id order.
+
+        `fields` selects the returned fields. At most `limit` tickets are
+        returned after the `cursor` ticket id, the `next_cursor` of the
+        response starting the next page. The tickets are read in batches
+        of `query_batch_size`, with two queries per batch.
+        """
+        content_type = 'application/json'
+        username = self._authenticate(req, content_type)
+        if not username:
+            return
+
+        try:
+            columns, custom_fields, filters, cursor, limit = \
+                self._parse_query(req)
+        except ValueError as ex:
+            content = {
+                'message': 'invalid_query',
+                'description': exception_to_unicode(ex)
+            }
+            self._send_json(req, 400, content, content_type)
+            return
+
+        perm = PermissionCache(self.env, username)
+        batch_size = max(1, self.config.getint(
+            *CONFIG_FIELD['query_batch_size']))
+        self.metrics.count_status(200)
+        req.send_response(200)
+        req.send_header('Content-Type', content_type)
+        req.end_headers()
+        req.write('{"tickets": [')
+        count = 0
+        more = True
+        separator = ''
+        while more and count < limit:
+            size = min(batch_size, limit - count)
+            with self._timer(req, 'ticket_query'):
+                rows = self._query_tickets(columns, filters, cursor, size)
+                customs = self._query_custom_fields(
+                    [row[0] for row in rows], custom_fields)
+            more = len(rows) == size
+            chunk = []
+            for row in rows:
+                cursor = row[0]
+                if not perm.has_permission('TICKET_VIEW',
+                                           Resource('ticket', cursor)):
+                    continue
+                ticket = {'id': cursor}
+                for name, value in zip(columns, row[1:]):
+                    if name in TIME_COLUMNS and value is not None:
+                        value = from_utimestamp(value).isoformat()
+                    ticket[name] = value
+                for name in custom_fields:
+                    ticket[name] = customs.get((cursor, name))
+                chunk.append(separator + json.dumps(ticket))
+                separator = ','
+                count += 1
+            req.write(''.join(chunk))
+        req.write('], "next_cursor": %s}' % json.dumps(cursor if more
+                                                        else None))
+
+    def _parse_query(self, req):
+        """Return the selected ticket columns and custom fields, the
+        filters as a list of `(name, values, is_custom)`, the cursor and
+        the limit of the query."""
+        custom_names = [name for name, f in
+                        self._get_field_schema().iteritems()
+                        if f.get('custom')]
+        known = set(TICKET_COLUMNS) | set(custom_names)
+        repeated = [name for name in ('fields', 'cursor', 'limit')
+                    if isinstance(req.args.get(name), list)]
+        if repeated:
+            raise ValueError('Repeated arguments: %s' % ', '.join(repeated))
+
+        fields = req.args.get('fields')
+        if fields:
+            fields = [f.strip() for f in fields.split(',') if f.strip()]
+            unknown = [f for f in fields if f not in known and f != 'id']
+            if unknown:
+                raise ValueError('Unknown fields: %s' % ', '.join(unknown))
+        else:
+            fields = list(TICKET_COLUMNS) + custom_names
+        columns = [f for f in fields if f in TICKET_COLUMNS]
+        custom_fields = [f for f in fields if f in custom_names]
+
+        filters = []
+        for name, values in req.args.iteritems():
+            if name in QUERY_ARGS or name.startswith('__'):
+                continue
+            if name not in known:
+                raise ValueError('Unknown filter: %s' % name)
+            if not isinstance(values, list):
+                values = [values]
+            values = [v for value in values for v in value.split('|')]
+            filters.append((name, values, name in custom_names))
+
+        try:
+            cursor = int(req.args.get('cursor') or 0)
+            limit = int(req.args.get('limit') or
+                        self.config.getint(*CONFIG_FIELD['query_limit']))
+        except ValueError:
+            raise ValueError('cursor and limit must be integers')
+        limit = min(max(limit, 1),
+                    self.config.getint(*CONFIG_FIELD['query_max_limit']))
+        return columns, custom_fields, filters, cursor, limit
+
+    def _query_tickets(self, columns, filters, cursor, size):
+        where = ['id>%s']
+        args = [cursor]
+        for name, values, is_custom in filters:
+            placeholders = ','.join(['%s'] * len(values))
+            if is_custom:
+                clause = "id IN (SELECT ticket FROM ticket_custom " \
+                         "WHERE name=%%s AND value IN (%s))" % placeholders
+                args.append(name)
+            else:
+                clause = "%s IN (%s)" % (name, placeholders)
+                if '' in values:
+                    clause = "(%s OR %s IS NULL)" % (clause, name)
+            where.append(clause)
+            args.extend(values)
+        return self.env.db_query("""
+            SELECT %s FROM ticket WHERE %s ORDER BY id LIMIT %d
+            """ % (','.join(['id'] + columns), ' AND '.join(where), size),
+            args)
+
+    def _query_custom_fields(self, ids, names):
+        """Return the `names` custom fields of the tickets, as a
+        `{(ticket_id, name): value}` dictionary."""
+        if not ids or not names:
+            return {}
+        return dict(((ticket, name), value)
+                    for ticket, name, value in self.env.db_query("""
+                        SELECT ticket, name, value FROM ticket_custom
+                        WHERE ticket IN (%s) AND name IN (%s)
+                        """ % (','.join(['%s'] * len(ids)),
+                                 ','.join(['%s'] * len(names))),
+                        list(ids) + list(names)))
+
+    @staticmethod
+    def _ticket_to_json(t, fields=None):
+        """Return the values of the ticket fields, all of them when
+        `fields` is `None`, with the times in the ISO 8601 format."""
+        content = {'id': t.id}
+        for name, value in t.values.iteritems():
+            if fields is not None and name not in fields:
+                continue
+            if isinstance(value, datetime):
+                value = value.isoformat()
+            content[name] = value
+        return content
+
+    def _rate_limited(self, req, limiter, key, content_type):
+        """Send a 429 response and return `True` when `key` exceeded its
+        rate limit."""
+        wait = limiter.acquire(key)
+        if not wait:
+            return False
+        content = {
+            'message': 'rate_limited',
+            'description': 'Too many requests, retry in %.1f seconds' % wait
+        }
+        self._send_json(req, 429, content, content_type,
+                        headers={'Retry-After': int(math.ceil(wait))})
+        return True
+
+    def _process_batch_request(self, req, username, post_bodies,
+                               content_type, idempotency=None):
+        max_size = self.config.getint(*CONFIG_FIELD['batch_max_size'])
+        if len(post_bodies) > max_size:
+            content = {
+                'message': 'batch_too_large',
+                'description': 'At most %d tickets can be created at once'
+                               % max_size
+            }
+            self._send_json(req, 413, content, content_type)
+            return
+        if not post_bodies:
+            content = {
+                'message': 'invalid_json_value',
+                'description': 'Empty batch'
+            }
+            self._send_json(req, 400, content, content_type)
+            return
+
+        try:
+            results = self._create_batch(req, username, post_bodies,
+                                         idempotency)
+        except Exception as ex:
+            # Only raised with an idempotency key, a concurrent request with
+            # the same key may have won
+            if self._replay_idempotent_response(req, idempotency,
+                                                content_type):
+                return
+            self.log.error('_create_batch() failed. %s', ex)
+            content = {
+                'message': 'service_unavailable',
+                'description': 'The tickets could not be created, retry '
+                               'with the same Idempotency-Key'
+            }
+            self._send_json(req, 503, content, content_type,
+                            headers={'Retry-After': 1})
+            return
+        self._send_json(req, self._batch_status(results),
+                        {'tickets': results}, content_type)
+
+    @staticmethod
+    def _batch_status(results):
+        failed = len([r for r in results if 'ticket_id' not in r])
+        if not failed:
+            return 201
+        elif failed < len(results):
+            return 207
+        return 400
+
+    @staticmethod
+    def _is_multipart(req):
+        content_type = req.get_header('Content-Type') or ''
+        return cgi.parse_header(content_type)[0] == 'multipart/form-data'
+
+    def _process_multipart_request(self, req, username, idempotency=None):
+        """Create a ticket with attachments from a multipart/form-data body:
+        the ticket as JSON in the `ticket` field, and the files in any other
+        field.
+
+        The body is read in chunks of `multipart_chunk_size` bytes, the files
+        being spooled to temporary files, and rejected with a `413` as soon
+        as one of them exceeds the `[attachment] max_size`. Bodies which
+        cannot fit in `multipart_max_files` such files and `max_body_size`
+        bytes for the ticket are rejected before being read.
+        """
+        content_type = 'application/json'
+        if 'TICKET_APPEND' not in self._get_groups(username, req):
+            self._send_forbidden(req, 'TICKET_APPEND', username, content_type)
+            return
+
+        boundary = cgi.parse_header(
+            req.get_header('Content-Type'))[1].get('boundary')
+        max_size = self.config.getint('attachment', 'max_size')
+        max_files = self.config.getint(*CONFIG_FIELD['multipart_max_files'])
+        max_body_size = self.config.getint(*CONFIG_FIELD['max_body_size'])
+        max_length = max(0, max_files) * max_size + max_body_size \
+                     if max_size >= 0 and max_body_size > 0 else 0
+        length = as_int(req.get_header('Content-Length'), 0)
+        if max_length and length > max_length:
+            content = {
+                'message': 'body_too_large',
+                'description': 'The request body exceeds %d bytes'
+                               % max_length
+            }
+            self._send_json(req, 413, content, content_type)
+            return
+
+        try:
+            if not boundary:
+                raise MultipartError('Missing boundary')
+            with self._timer(req, 'multipart_read'):
+                # The ticket is the only field which is not a file
+                parts = parse_multipart(
+                    req.read, length, boundary,
+                    max_size if max_size >= 0 else None, max_files,
+                    self.config.getint(*CONFIG_FIELD['multipart_chunk_size']),
+                    max_fields=1)
+        except PartTooLarge as ex:
+            self.log.info('_process_multipart_request() rejected a part. %s',
+                          ex)
+            content = {
+                'message': 'attachment_too_large',
+                'description': exception_to_unicode(ex)
+            }
+            self._send_json(req, 413, content, content_type)
+            return
+        except ValueError as ex:
+            self.log.error('parse_multipart() failed. %s', ex)
+            content = {
+                'message': 'invalid_multipart',
+                'description': exception_to_unicode(ex)
+            }
+            self._send_json(req, 400, content, content_type)
+            return
+
+        try:
+            tickets = [part for part in parts
+                       if part.name == 'ticket' and part.filename is None]
+            files = [part for part in parts if part.filename]
+            try:
+                if len(tickets) != 1:
+                    raise ValueError('A single ticket field is required')
+                post_body = json.loads(tickets[0].value)
+                content = self._create_with_attachments(
+                    req, username, post_body, files, idempotency)
+                status = 201
+            except InvalidTicketFields as ex:
+                self.log.info('_create_with_attachments() rejected invalid '
+                              'fields. %s', ex)
+                content = self._item_error(ex)
+                status = 400
+            except ValueError as ex:
+                self.log.error('_create_with_attachments() failed. %s', ex)
+                content = self._item_error(ex)
+                status = 400
+            except Exception as ex:
+                # A concurrent request with the same key may have won
+                if idempotency and self._replay_idempotent_response(
+                        req, idempotency, content_type):
+                    return
+                self.log.error('_create_with_attachments() failed. %s', ex)
+                content = self._item_error(ex)
+                status = 400
+                # May be transient (locked database, ...), let it be retried
+                idempotency = None
+        finally:
+            for part in parts:
+                part.close()
+        if idempotency and status != 201:
+            self._store_idempotent_response(idempotency, status, content)
+        self._send_json(req, status, content, content_type)
+
+    def _process_ndjson_request(self, req, username):
+        """Create a ticket for each line of the request body, streaming
+        back a result line per ticket once its chunk is committed.
+        """
+        chunk_size = max(1, self.config.getint(
+            *CONFIG_FIELD['ndjson_chunk_size']))
+        self.metrics.count_status(200)
+        req.send_response(200)
+        req.send_header('Content-Type', 'application/x-ndjson')
+        req.end_headers()
+
+        max_line_size = self.config.getint(*CONFIG_FIELD['max_body_size'])
+        chunk = []  # [(lineno, post_body or exception)]
+        for lineno, line in enumerate(self._iter_lines(req, max_line_size),
+                                      1):
+            if line is None:
+                chunk.append((lineno, ValueError('Line exceeds %d bytes'
+                                                 % max_line_size)))
+            elif not line.strip():
+                continue
+            else:
+                try:
+                    with self._timer(req, 'json_decode'):
+                        chunk.append((lineno, json.loads(line)))
+                except ValueError as ex:
+                    chunk.append((lineno, ex))
+            if len(chunk) >= chunk_size:
+                self._create_ndjson_chunk(req, username, chunk)
+                chunk = []
+        if chunk:
+            self._create_ndjson_chunk(req, username, chunk)
+
+    def _create_ndjson_chunk(self, req, username, chunk):
+        valid = [(lineno, post_body) for lineno, post_body in chunk
+                 if not isinstance(post_body, Exception)]
+        created = dict(zip([lineno for lineno, _ in valid],
+                           self._create_batch(req, username,
+                                              [b for _, b in valid])))
+        lines = []
+        for lineno, post_body in chunk:
+            if lineno in created:
+                result = created[lineno]
+            else:
+                self.log.error('_read_json() failed. %s', post_body)
+                result = self._item_error(post_body)
+            result['line'] = lineno
+            with self._timer(req, 'response'):
+                lines.append(json.dumps(result) + '\n')
+        req.write(''.join(lines))
+
+    @staticmethod
+    def _iter_lines(req, max_size=0, bufsize=65536):
+        """Read the request body incrementally, yielding it line by
+        line. Lines longer than `max_size` bytes are yielded as `None`,
+        the rest of them being skipped."""
+        remaining = as_int(req.get_header('content-length'), 0)
+        pieces = []  # the start of the current line
+        size = 0
+        skipping = False
+        while remaining > 0:
+            data = req.read(min(bufsize, remaining))
+            if not data:
+                break
+            remaining -= len(data)
+            start = 0
+            while True:
+                end = data.find('\n', start)
+                last = end < 0
+                if last:
+                    end = len(data)
+                if not skipping:
+                    size += end - start
+                    if max_size > 0 and size > max_size:
+                        pieces = []
+                        skipping = True
+                        yield None
+                    else:
+                        pieces.append(data[start:end])
+                if last:
+                    break
+                if not skipping:
+                    yield ''.join(pieces)
+                pieces = []
+                size = 0
+                skipping = False
+                start = end + 1
+        if pieces and not skipping:
+            yield ''.join(pieces)
 
+    def _read_json(self, req):
         content_len = int(req.get_header('content-length') or 0)
 
         # Read request body
-        post_body = json.loads(req.read(content_len))
+        with self._timer(req, 'json_decode'):
+            post_body = json.loads(req.read(content_len))
         self.log.debug('BODY=%s' % post_body)
+        return post_body
+
+    def _create(self, req, authname_, post_body, idempotency=None):
+        """ Create a new ticket, returning the ticket ID.
+        Overriding 'when' requires admin permission.
+
+        The response is stored for the `(token_hash, key)` idempotency key
+        in the same transaction. With group commit enabled, the insert
+        shares its transaction with the concurrent requests, and is
+        inserted again on its own should that transaction be rolled back:
+        the `ticket_created` listeners, called by `Ticket.insert()` before
+        the commit, then run twice. """
+
+        t, when, notify = self._prepare_ticket(req, authname_, post_body)
+
+        def insert(db):
+            t.insert(when=when)
+            if idempotency:
+                self._store_idempotent_response(
+                    idempotency, 201, {'ticket_id': t.id}, db)
+
+        grouped = self._join_group_commit(idempotency)
+        try:
+            with self._timer(req, 'ticket_insert'):
+                if not grouped or not self._group_commit.run(insert):
+                    if t.exists:
+                        # Inserted by a group commit which was rolled back
+                        t, when, notify = self._prepare_ticket(
+                            req, authname_, post_body)
+                    with self.env.db_transaction as db:
+                        insert(db)
+        finally:
+            if grouped and idempotency:
+                with self._group_commit_keys_lock:
+                    self._group_commit_keys.discard(idempotency)
+        if idempotency:
+            self._idempotency_cache.set(idempotency, (201, {'ticket_id': t.id}))
+        if notify:
+            self._notify(t)
+        return t.id
+
+    def _join_group_commit(self, idempotency):
+        """Return whether the insert can share a group commit. It cannot
+        while a concurrent request holds the same idempotency key: the
+        duplicate row would roll the whole group back.
+        """
+        if self._group_commit is None:
+            return False
+        if idempotency:
+            with self._group_commit_keys_lock:
+                if idempotency in self._group_commit_keys:
+                    return False
+                self._group_commit_keys.add(idempotency)
+        return True
+
+    def _create_with_attachments(self, req, authname_, post_body, files,
+                                 idempotency=None):
+        """ Create a new ticket and its attachments in one transaction,
+        returning the ticket ID and the names of the attachments. """
+
+        # Imported on first use, only multipart requests need it
+        from trac.attachment import Attachment
+
+        t, when, notify = self._prepare_ticket(req, authname_, post_body)
+        attachments = []
+        try:
+            with self._timer(req, 'ticket_insert'), \
+                    self.env.db_transaction as db:
+                t.insert(when=when)
+                for part in files:
+                    attachment = Attachment(self.env, 'ticket', t.id)
+                    attachment.author = t['reporter']
+                    part.file.seek(0)
+                    attachment.insert(part.filename, part.file, part.size,
+                                      t=when)
+                    attachments.append(attachment)
+                content = {
+                    'ticket_id': t.id,
+                    'attachments': [a.filename for a in attachments]
+                }
+                if idempotency:
+                    self._store_idempotent_response(idempotency, 201,
+                                                    content, db)
+        except Exception:
+            # The files are not removed by the rollback
+            for attachment in attachments:
+                try:
+                    os.unlink(attachment.path)
+                except OSError:
+                    pass
+            raise
+        if idempotency:
+            self._idempotency_cache.set(idempotency, (201, content))
+        if notify:
+            self._notify(t)
+        return content
+
+    def _create_batch(self, req, authname_, post_bodies, idempotency=None):
+        """ Create the tickets in a single transaction, returning a result
+        per ticket: either `{'ticket_id': id}` or an error description.
+
+        Invalid tickets are reported without being inserted. Should an
+        insert fail, the transaction is rolled back and the tickets are
+        inserted again one transaction at a time, the `ticket_created`
+        listeners having already run for the rolled back inserts.
+
+        With an idempotency key, the response is stored in the same
+        transaction, and a failed insert is raised instead: inserting the
+        tickets one by one could create some of them twice on a retry. """
+
+        results = [None] * len(post_bodies)
+        prepared = []
+        for i, post_body in enumerate(post_bodies):
+            try:
+                prepared.append(
+                    (i, self._prepare_ticket(req, authname_, post_body)))
+            except Exception as ex:
+                self.log.error('_prepare_ticket() failed. %s', ex)
+                results[i] = self._item_error(ex)
+
+        try:
+            with self._timer(req, 'ticket_insert'), \
+                    self.env.db_transaction as db:
+                for i, (t, when, notify) in prepared:
+                    t.insert(when=when)
+                    results[i] = {'ticket_id': t.id}
+                if idempotency:
+                    self._store_idempotent_response(
+                        idempotency, self._batch_status(results),
+                        {'tickets': results}, db)
+        except Exception as ex:
+            if idempotency:
+                raise
+            self.log.warn('Batch insert failed, inserting the tickets one '
+                          'by one. %s', ex)
+            for i, _ in prepared:
+                try:
+                    results[i] = {
+                        'ticket_id': self._create(req, authname_,
+                                                  post_bodies[i])
+                    }
+                except Exception as ex:
+                    self.log.error('_create() failed. %s', ex)
+                    results[i] = self._item_error(ex)
+        else:
+            if idempotency:
+                self._idempotency_cache.set(
+                    idempotency,
+                    (self._batch_status(results), {'tickets': results}))
+            for i, (t, when, notify) in prepared:
+                if notify:
+                    self._notify(t)
+        return results
+
+    @staticmethod
+    def _item_error(ex):
+        if isinstance(ex, InvalidTicketFields):
+            return {
+                'message': 'invalid_fields',
+                'description': 'Invalid ticket fields',
+                'errors': ex.errors
+            }
+        return {
+            'message': 'invalid_json_value',
+            'description': 'Invalid ticket: %s' % exception_to_unicode(ex)
+        }
+
+    def _prepare_ticket(self, req, authname_, post_body):
+        """ Build the ticket described by the request body, returning the
+        ticket, its creation time and whether to notify. """
 
         # Prepare props
-        summary = post_body['summary'] or ''
+        if not isinstance(post_body, dict):
+            raise ValueError('A ticket must be a JSON object')
+        notify = as_bool(post_body.get('notify', False))
+        attributes = self._validate_fields(
+            dict(item for item in post_body.iteritems()
+                 if item[0] != 'notify'),
+            CREATE_PROTECTED_FIELDS)
+        summary = attributes.get('summary') or ''
         description = ''
         #author = post_body['author']
         #reporter = post_body['reporter'] or authname_
-        attributes = {}
-        for key, value in post_body.iteritems():
-            attributes[key] = value
-        author = ''
-        if 'reporter' in post_body:
-            author = post_body['reporter']
-        notify = False
+        author = attributes.get('reporter') or ''
         when = None
 
         # Validate inputs
         if not summary:
-            raise ValueError('Empty field. Field name = summary')
+            raise InvalidTicketFields({'summary': 'empty field'})
         #if not author:
         #    raise ValueError('Empty field. Field name = author')
 
@@ -223,7 +1579,7 @@ class TicketAPI(Component):
         t['resolution'] = ''
 
         # custom author?
-        if author and not (authname_ == 'anonymous' or 'TICKET_ADMIN' in self._get_groups(authname_)):
+        if author and not (authname_ == 'anonymous' or 'TICKET_ADMIN' in self._get_groups(authname_, req)):
             # only allow custom author if anonymous is permitted or user is admin
             self.log.warn("RPC ticket.create: %r not allowed to change author "
                           "to %r for comment on #%s", authname_, author, t['ticket_id'])
@@ -234,21 +1590,97 @@ class TicketAPI(Component):
 
         # custom create timestamp?
         when = when or getattr(req, NAME_RPC_TIMESTAMP, None)
-        if when and 'TICKET_ADMIN' not in self._get_groups(authname_):
+        if when and 'TICKET_ADMIN' not in self._get_groups(authname_, req):
             self.log.warn("RPC ticket.create: %r not allowed to create with "
                           "non-current timestamp (%r)", authname_, when)
             when = None
         when = when or to_datetime(None, utc)
-        t.insert(when=when)
-        if notify:
-            try:
-                tn = TicketNotifyEmail(self.env)
-                tn.notify(t, newticket=True)
-            except Exception, e:
-                self.log.exception("Failure sending notification on creation "
-                                   "of ticket #%s: %s" % (t.id, e))
-        return t.id
+        return t, when, notify
+
+    def _get_field_schema(self):
+        """Return the ticket fields by name.
+
+        The schema is derived from the fields cached by `TicketSystem`, and
+        is rebuilt whenever Trac invalidates them: on changes to the
+        milestones, components, versions or enums. Changing trac.ini
+        reloads the environment and this component with it.
+        """
+        fields = TicketSystem(self.env).fields
+        if fields is not self._field_schema_source:
+            self._field_schema = dict((f['name'], f) for f in fields)
+            self._field_schema_source = fields
+        return self._field_schema
+
+    def _validate_fields(self, values, protected):
+        """Check the ticket field values against the ticket field schema,
+        returning them coerced to the expected types. The `protected`
+        fields can not be set.
+
+        All the invalid fields are reported together by raising
+        `InvalidTicketFields`.
+        """
+        schema = self._get_field_schema()
+        attributes = {}
+        errors = {}
+        for name, value in values.iteritems():
+            field = schema.get(name)
+            if field is None:
+                errors[name] = 'unknown field'
+                continue
+            if name in protected:
+                errors[name] = 'read-only field'
+                continue
+            if value is None:
+                value = ''
+            if isinstance(value, (list, dict)):
+                errors[name] = 'must be a string'
+                continue
+            if field['type'] == 'checkbox':
+                value = '1' if as_bool(value) else '0'
+            elif not isinstance(value, unicode):
+                value = unicode(value)
+            if field['type'] in ('select', 'radio') and \
+                    value not in field.get('options', ()) and \
+                    not (value == '' and field.get('optional')):
+                errors[name] = 'invalid value "%s", expected one of: %s' \
+                               % (value, ', '.join(field.get('options', ())))
+                continue
+            attributes[name] = value
+        if errors:
+            raise InvalidTicketFields(errors)
+        return attributes
+
+    def _notify(self, t):
+        # Sent in the background once the ticket is committed
+        self._notification_queue.enqueue(t.id, newticket=True)
+
+    def _get_groups(self, user, req=None):
+        """Return the permission actions granted to `user`.
+
+        The permissions are resolved at most once per request. When
+        `permission_cache_ttl` is set they are also shared between requests
+        for that many seconds, permission changes only taking effect once
+        the entries expire.
+        """
+        memo = getattr(req, '_access_token_perms', None)
+        if memo is None:
+            memo = {}
+            if req is not None:
+                req._access_token_perms = memo
+        if user in memo:
+            return memo[user]
+
+        cached = self._perm_cache.ttl > 0
+        if cached:
+            perms = self._perm_cache.get(user)
+            if perms is not None:
+                memo[user] = perms
+                return perms
 
-    def _get_groups(self, user):
-        self.log.debug(PermissionSystem(self.env).get_user_permissions(user))
-        return PermissionSystem(self.env).get_user_permissions(user)
+        with self._timer(req, 'permissions'):
+            perms = PermissionSystem(self.env).get_user_permissions(user)
+        self.log.debug("Permissions of %s: %s", user, perms)
+        if cached:
+            self._perm_cache.set(user, perms)
+        memo[user] = perms
+        return perms
@@ -1,3 +1,223 @@
 # -*- coding: utf-8 -*-
 
 NAME_RPC_TIMESTAMP = 'rpc_timestamp'
+NAME_TOKEN_GENERATION = 'kkbox_trac_access_token_generation'
+
+CONFIG_SECTION_NAME = 'access_token_plugin'
+CONFIG_FIELD = {
+    'menu_label': (
+        CONFIG_SECTION_NAME,
+        'menu_label',
+        'Access Tokens',
+    ),
+    'ticket_status': (
+        CONFIG_SECTION_NAME,
+        'ticket_status',
+        'new, accepted, assigned, reopened, closed',
+    ),
+    'ticket_status_enable': (
+        CONFIG_SECTION_NAME,
+        'ticket_status_enable',
+        'new, accepted, assigned, reopened, closed',
+    ),
+    'insensitive_group': (
+        CONFIG_SECTION_NAME,
+        'insensitive_group',
+        'intern,outsourcing',
+    ),
+    'sensitive_keyword': (
+        CONFIG_SECTION_NAME,
+        'isensitive_keyword',
+        'secret',
+    ),
+    'token_cache_size': (
+        CONFIG_SECTION_NAME,
+        'token_cache_size',
+        1000,
+    ),
+    'token_cache_ttl': (
+        CONFIG_SECTION_NAME,
+        'token_cache_ttl',
+        300,
+    ),
+    'token_cache_check_interval': (
+        CONFIG_SECTION_NAME,
+        'token_cache_check_interval',
+        2,
+    ),
+    'negative_token_cache_size': (
+        CONFIG_SECTION_NAME,
+        'negative_token_cache_size',
+        10000,
+    ),
+    'negative_token_cache_ttl': (
+        CONFIG_SECTION_NAME,
+        'negative_token_cache_ttl',
+        60,
+    ),
+    'permission_cache_size': (
+        CONFIG_SECTION_NAME,
+        'permission_cache_size',
+        1000,
+    ),
+    'permission_cache_ttl': (
+        CONFIG_SECTION_NAME,
+        'permission_cache_ttl',
+        0,
+    ),
+    'batch_max_size': (
+        CONFIG_SECTION_NAME,
+        'batch_max_size',
+        100,
+    ),
+    'max_body_size': (
+        CONFIG_SECTION_NAME,
+        'max_body_size',
+        10485760,
+    ),
+    'ndjson_chunk_size': (
+        CONFIG_SECTION_NAME,
+        'ndjson_chunk_size',
+        100,
+    ),
+    'notify_workers': (
+        CONFIG_SECTION_NAME,
+        'notify_workers',
+        2,
+    ),
+    'notify_queue_size': (
+        CONFIG_SECTION_NAME,
+        'notify_queue_size',
+        1000,
+    ),
+    'notify_max_retries': (
+        CONFIG_SECTION_NAME,
+        'notify_max_retries',
+        3,
+    ),
+    'notify_retry_delay': (
+        CONFIG_SECTION_NAME,
+        'notify_retry_delay',
+        1.0,
+    ),
+    'last_use_flush_interval': (
+        CONFIG_SECTION_NAME,
+        'last_use_flush_interval',
+        60,
+    ),
+    'last_use_flush_threshold': (
+        CONFIG_SECTION_NAME,
+        'last_use_flush_threshold',
+        100,
+    ),
+    'rate_limit_per_token': (
+        CONFIG_SECTION_NAME,
+        'rate_limit_per_token',
+        0,
+    ),
+    'rate_limit_per_token_burst': (
+        CONFIG_SECTION_NAME,
+        'rate_limit_per_token_burst',
+        10,
+    ),
+    'rate_limit_per_user': (
+        CONFIG_SECTION_NAME,
+        'rate_limit_per_user',
+        0,
+    ),
+    'rate_limit_per_user_burst': (
+        CONFIG_SECTION_NAME,
+        'rate_limit_per_user_burst',
+        20,
+    ),
+    'max_concurrent_requests': (
+        CONFIG_SECTION_NAME,
+        'max_concurrent_requests',
+        0,
+    ),
+    'slow_request_threshold': (
+        CONFIG_SECTION_NAME,
+        'slow_request_threshold',
+        0,
+    ),
+    'token_lifetime': (
+        CONFIG_SECTION_NAME,
+        'token_lifetime',
+        0,
+    ),
+    'expired_token_sweep_interval': (
+        CONFIG_SECTION_NAME,
+        'expired_token_sweep_interval',
+        3600,
+    ),
+    'expired_token_sweep_batch': (
+        CONFIG_SECTION_NAME,
+        'expired_token_sweep_batch',
+        100,
+    ),
+    'idempotency_window': (
+        CONFIG_SECTION_NAME,
+        'idempotency_window',
+        86400,
+    ),
+    'idempotency_sweep_interval': (
+        CONFIG_SECTION_NAME,
+        'idempotency_sweep_interval',
+        3600,
+    ),
+    'idempotency_cache_size': (
+        CONFIG_SECTION_NAME,
+        'idempotency_cache_size',
+        1000,
+    ),
+    'query_limit': (
+        CONFIG_SECTION_NAME,
+        'query_limit',
+        100,
+    ),
+    'query_max_limit': (
+        CONFIG_SECTION_NAME,
+        'query_max_limit',
+        10000,
+    ),
+    'query_batch_size': (
+        CONFIG_SECTION_NAME,
+        'query_batch_size',
+        500,
+    ),
+    'group_commit_max_wait': (
+        CONFIG_SECTION_NAME,
+        'group_commit_max_wait',
+        0,
+    ),
+    'group_commit_max_size': (
+        CONFIG_SECTION_NAME,
+        'group_commit_max_size',
+        50,
+    ),
+    'read_database': (
+        CONFIG_SECTION_NAME,
+        'read_database',
+        '',
+    ),
+    'read_database_pool_size': (
+        CONFIG_SECTION_NAME,
+        'read_database_pool_size',
+        2,
+    ),
+    'read_database_timeout': (
+        CONFIG_SECTION_NAME,
+        'read_database_timeout',
+        1.0,
+    ),
+    'multipart_max_files': (
+        CONFIG_SECTION_NAME,
+        'multipart_max_files',
+        10,
+    ),
+    'multipart_chunk_size': (
+        CONFIG_SECTION_NAME,
+        'multipart_chunk_size',
+        65536,
+    ),
+}
@@ -3,8 +3,9 @@
 
 from trac.db import Table, Column, Index, DatabaseManager
 
-version = 2
+version = 8
 name = 'kkbox_trac_access_token'
+idempotency_name = name + '_idempotency'
 tables = [
     Table(name, key='id')[
         Column('id', auto_increment=True),
@@ -13,6 +14,19 @@ tables = [
         Column('username'),
         Column('change_time', type='int64'),
         Column('create_time', type='int64'),
-        Column('last_use_time', type='int64')
+        Column('last_use_time', type='int64'),
+        Column('use_count', type='int'),
+        Column('expire_time', type='int64'),
+        Index(['access_token'], unique=True),
+        Index(['username', 'create_time']),
+        Index(['expire_time'])
+    ],
+    Table(idempotency_name, key=('access_token', 'idempotency_key'))[
+        Column('access_token'),
+        Column('idempotency_key'),
+        Column('status', type='int'),
+        Column('response'),
+        Column('create_time', type='int64'),
+        Index(['create_time'])
     ]
 ]
@@ -0,0 +1,236 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Incremental upgrades of the plugin tables.
+
+`do_upgrade_<version>(env, db)` upgrades the tables from the previous
+version to `version`. Versions older than `REBUILD_VERSION` are rebuilt
+from scratch, their rows being copied in bounded chunks.
+"""
+
+from datetime import datetime
+
+from trac.db import DatabaseManager
+from trac.util.datefmt import to_utimestamp, utc
+
+import db_default
+
+REBUILD_VERSION = 2
+CHUNK_SIZE = 1000
+# Columns of the token table which used to hold datetime strings
+TIME_COLUMNS = ('create_time', 'change_time', 'last_use_time')
+
+
+def create_tables(env, db):
+    db_manager, _ = DatabaseManager(env)._get_connector()
+    cursor = db.cursor()
+    for table in db_default.tables:
+        for sql in db_manager.to_sql(table):
+            cursor.execute(sql)
+
+
+def rebuild_tables(env, db):
+    db_manager, _ = DatabaseManager(env)._get_connector()
+    cursor = db.cursor()
+    for table in db_default.tables:
+        if table.name == db_default.name:
+            # The times are converted as do_upgrade_5 does
+            convert = lambda value: _parse_timestamp(env, value)
+            rebuild_table(env, db, table,
+                          dict((column, convert) for column in TIME_COLUMNS))
+        else:
+            # Tables added after REBUILD_VERSION
+            for sql in db_manager.to_sql(table):
+                cursor.execute(sql)
+
+
+def rebuild_table(env, db, table, converters=None):
+    """Recreate `table` with its current schema, keeping the rows of the
+    columns it still has. The values of the columns of `converters` are
+    passed through their function while being copied.
+    """
+    db_manager, _ = DatabaseManager(env)._get_connector()
+    cursor = db.cursor()
+    old_name = table.name + '_old'
+    cursor.execute("CREATE TABLE %s AS SELECT * FROM %s"
+                   % (old_name, table.name))
+    cursor.execute("DROP TABLE " + table.name)
+    for sql in db_manager.to_sql(table):
+        cursor.execute(sql)
+
+    cursor.execute("SELECT * FROM %s WHERE 1=0" % old_name)
+    names = [column.name for column in table.columns]
+    cols = [x[0] for x in cursor.description if x[0] in names]
+    key = table.key[0] if table.key else None
+    if key in cols:
+        # Older schemas had no unique index, drop the duplicated rows
+        # which would violate it now.
+        for index in table.indices:
+            if index.unique and len(index.columns) == 1 and \
+                    index.columns[0] in cols:
+                _delete_duplicates(env, db, old_name, index.columns[0], key)
+
+    insert = "INSERT INTO %s (%s) VALUES (%s)" \
+             % (table.name, ','.join(cols), ','.join(['%s'] * len(cols)))
+    converters = converters or {}
+    convert_at = [(i, converters[col]) for i, col in enumerate(cols)
+                  if col in converters]
+    copied = 0
+    for rows in _iter_chunks(db, old_name, cols, key):
+        if convert_at:
+            rows = [list(row) for row in rows]
+            for row in rows:
+                for i, convert in convert_at:
+                    row[i] = convert(row[i])
+        cursor.executemany(insert, rows)
+        copied += len(rows)
+    if key in cols:
+        db.update_sequence(cursor, table.name, key)
+    cursor.execute("DROP TABLE " + old_name)
+    env.log.info("Copied %d rows into the rebuilt table %s",
+                 copied, table.name)
+
+
+def do_upgrade_3(env, db):
+    """Index the token hash, and the tokens of a user by creation time."""
+    table = _get_table(db_default.name)
+    _delete_duplicates(env, db, table.name, 'access_token', 'id')
+    cursor = db.cursor()
+    cursor.execute(_index_sql(env, table, ['access_token']))
+    cursor.execute(_index_sql(env, table, ['username', 'create_time']))
+
+
+def do_upgrade_4(env, db):
+    """Count the uses of the tokens."""
+    cursor = db.cursor()
+    cursor.execute("ALTER TABLE kkbox_trac_access_token "
+                   "ADD COLUMN use_count integer")
+
+
+def do_upgrade_5(env, db):
+    """Store the creation and change times of the tokens as microsecond
+    timestamps, they used to be stored as datetime strings.
+    """
+    cursor = db.cursor()
+    converted = 0
+    for rows in _iter_chunks(db, db_default.name,
+                             ['id', 'create_time', 'change_time'], 'id'):
+        updates = []
+        for id_, create_time, change_time in rows:
+            create_ts = _parse_timestamp(env, create_time)
+            change_ts = _parse_timestamp(env, change_time)
+            if create_ts != create_time or change_ts != change_time:
+                updates.append((create_ts, change_ts, id_))
+        cursor.executemany("""
+            UPDATE kkbox_trac_access_token
+            SET create_time=%s, change_time=%s
+            WHERE id=%s
+            """, updates)
+        converted += len(updates)
+    env.log.info("Converted the timestamps of %d access tokens", converted)
+
+
+def do_upgrade_6(env, db):
+    """Let the tokens expire."""
+    cursor = db.cursor()
+    cursor.execute("ALTER TABLE kkbox_trac_access_token "
+                   "ADD COLUMN expire_time bigint")
+
+
+def do_upgrade_7(env, db):
+    """Remember the responses to the requests with an idempotency key."""
+    db_manager, _ = DatabaseManager(env)._get_connector()
+    cursor = db.cursor()
+    for sql in db_manager.to_sql(_get_table(db_default.idempotency_name)):
+        cursor.execute(sql)
+
+
+def do_upgrade_8(env, db):
+    """Index the expiry time of the tokens, for the sweeper."""
+    cursor = db.cursor()
+    cursor.execute(_index_sql(env, _get_table(db_default.name),
+                              ['expire_time']))
+
+
+def _parse_timestamp(env, value):
+    if value is None or isinstance(value, (int, long)):
+        return value
+    text = str(value)
+    try:
+        return long(text)
+    except ValueError:
+        pass
+    try:
+        if '.' in text[:26]:
+            t = datetime.strptime(text[:26], '%Y-%m-%d %H:%M:%S.%f')
+        else:
+            t = datetime.strptime(text[:19], '%Y-%m-%d %H:%M:%S')
+    except ValueError:
+        env.log.warn("Unable to convert the timestamp %r", value)
+        return value
+    return to_utimestamp(t.replace(tzinfo=utc))
+
+
+def _get_table(name):
+    for table in db_default.tables:
+        if table.name == name:
+            return table
+
+
+def _index_sql(env, table, columns):
+    db_manager, _ = DatabaseManager(env)._get_connector()
+    index_name = '%s_%s_idx' % (table.name, '_'.join(columns))
+    for sql in db_manager.to_sql(table):
+        if ' INDEX ' in sql and index_name in sql:
+            return sql
+    raise ValueError('No index on %s (%s)' % (table.name, ', '.join(columns)))
+
+
+def _delete_duplicates(env, db, table_name, column, key):
+    """Delete the rows sharing their `column` value, but the one with the
+    highest `key`.
+    """
+    cursor = db.cursor()
+    cursor.execute("SELECT %s FROM %s GROUP BY %s HAVING COUNT(*) > 1"
+                   % (column, table_name, column))
+    for value, in cursor.fetchall():
+        cursor.execute("SELECT %s FROM %s WHERE %s=%%s ORDER BY %s DESC"
+                       % (key, table_name, column, key), (value,))
+        ids = [(row[0],) for row in cursor.fetchall()[1:]]
+        cursor.executemany("DELETE FROM %s WHERE %s=%%s"
+                           % (table_name, key), ids)
+        env.log.warn("Deleted %d rows of %s duplicating %s",
+                     len(ids), table_name, column)
+
+
+def _iter_chunks(db, table_name, cols, key):
+    """Yield the rows of the table in chunks of at most `CHUNK_SIZE`,
+    paginated on `key` when the table has it.
+    """
+    cursor = db.cursor()
+    select = "SELECT %s FROM %s" % (','.join(cols), table_name)
+    if key in cols:
+        pos = cols.index(key)
+        last = None
+        while True:
+            if last is None:
+                cursor.execute(select + " ORDER BY %s LIMIT %d"
+                               % (key, CHUNK_SIZE))
+            else:
+                cursor.execute(select + " WHERE %s>%%s ORDER BY %s LIMIT %d"
+                               % (key, key, CHUNK_SIZE), (last,))
+            rows = cursor.fetchall()
+            if not rows:
+                break
+            yield rows
+            last = rows[-1][pos]
+    else:
+        offset = 0
+        while True:
+            cursor.execute(select + " LIMIT %d OFFSET %d"
+                           % (CHUNK_SIZE, offset))
+            rows = cursor.fetchall()
+            if not rows:
+                break
+            yield rows
+            offset += len(rows)
@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+
+import threading
+import time
+
+from trac.util.text import exception_to_unicode
+
+__all__ = ['GroupCommit']
+
+
+class _Entry(object):
+
+    __slots__ = ('func', 'queued', 'done', 'committed')
+
+    def __init__(self, func):
+        self.func = func
+        self.queued = True
+        self.done = False
+        self.committed = False
+
+
+class GroupCommit(object):
+    """Coalesce the writes of concurrent requests into shared transactions.
+
+    The first caller of `run()` becomes the leader: it waits up to
+    `max_wait` seconds for up to `max_size` writes to be queued, runs them
+    all in a single transaction and wakes the other callers up. There is
+    no background thread, a waiting caller takes over once the leader has
+    taken its batch.
+    """
+
+    def __init__(self, env, max_wait=0.005, max_size=50):
+        self.env = env
+        self.log = env.log
+        self.max_wait = max_wait
+        self.max_size = max(1, max_size)
+        self.batches = 0
+        self.writes = 0
+        self.failed = 0
+        self._pending = []
+        self._leader = False
+        self._cond = threading.Condition()
+
+    def run(self, func):
+        """Call `func(db)` in a transaction shared with the concurrent
+        callers, returning `False` when that transaction was rolled back.
+
+        The failing write is not known then, so the caller should retry
+        its write in a transaction of its own.
+        """
+        entry = _Entry(func)
+        with self._cond:
+            self._pending.append(entry)
+            self._cond.notify_all()
+        while True:
+            batch = self._next_batch(entry)
+            if batch is None:
+                return entry.committed
+            committed = self._commit(batch)
+            with self._cond:
+                for other in batch:
+                    other.committed = committed
+                    other.done = True
+                self._cond.notify_all()
+
+    def stats(self):
+        return {
+            'batches': self.batches,
+            'writes': self.writes,
+            'failed': self.failed,
+        }
+
+    def _next_batch(self, entry):
+        """Wait for `entry` to be committed, returning `None`, or for the
+        caller to become the leader, returning the batch to commit.
+        """
+        with self._cond:
+            while not entry.done and (self._leader or not entry.queued):
+                self._cond.wait()
+            if entry.done:
+                return None
+            self._leader = True
+            deadline = time.time() + self.max_wait
+            while len(self._pending) < self.max_size:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            batch = self._pending[:self.max_size]
+            del self._pending[:self.max_size]
+            for other in batch:
+                other.queued = False
+            self._leader = False
+            self._cond.notify_all()
+            return batch
+
+    def _commit(self, batch):
+        try:
+            with self.env.db_transaction as db:
+                for entry in batch:
+                    entry.func(db)
+        except Exception as ex:
+            self.log.warn("Group commit of %d writes failed. %s",
+                          len(batch), exception_to_unicode(ex))
+            with self._cond:
+                self.failed += 1
+            return False
+        with self._cond:
+            self.batches += 1
+            self.writes += len(batch)
+        return True
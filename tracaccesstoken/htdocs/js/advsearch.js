@@ -57,8 +57,23 @@ $(document).ready(function () {
 	$(search).attr('href', $(search).attr('href').replace('search', 'advsearch'));
 
 	var db = [];
-	if ($('#tokens').val()) {
-		db = JSON.parse($('#tokens').val());
+	var nextCursor = null;
+
+	function loadTokens(after) {
+		$.ajax({
+			method: 'GET',
+			url: 'accesstoken',
+			dataType: 'json',
+			data: {
+				action: 'GET',
+				after: after || ''
+			}
+		}).done(function(page) {
+			Array.prototype.push.apply(db, page.tokens);
+			nextCursor = page.next;
+			$('#tokenGrid').jsGrid('refresh');
+			$('#moreTokens').toggle(!!nextCursor);
+		});
 	}
 
 	$('#tokenGrid').jsGrid({
@@ -73,7 +88,6 @@ $(document).ready(function () {
 		},
 		onItemDeleted: function(arg) {
 			$("#tokenGrid").jsGrid("deleteItem", arg.item);
-			$('#tokens').val(JSON.stringify(arg.data));
       $('#tokenGrid').trigger('reloadGrid');
 			$.ajax({
 				method: 'DELETE',
@@ -88,7 +102,6 @@ $(document).ready(function () {
 			});
     },
 		onItemUpdated: function(arg) {
-			$('#tokens').val(JSON.stringify(db));
 			$.ajax({
 				method: 'PUT',
 				contentType: "application/json",
@@ -114,6 +127,24 @@ $(document).ready(function () {
 				title: "Creation Time",
 				editing: false
 			},
+			{
+				name: "lastUseTime",
+				type: "text",
+				title: "Last Used",
+				editing: false
+			},
+			{
+				name: "useCount",
+				type: "number",
+				title: "Uses",
+				editing: false
+			},
+			{
+				name: "expireTime",
+				type: "text",
+				title: "Expires",
+				editing: false
+			},
 			{
 				type: "control"
 			}
@@ -125,12 +156,13 @@ $(document).ready(function () {
       action: 'POST',
 			accessToken: Math.guid(),
 			description: $('#tokenDesc').val(),
+			expiresIn: $('#tokenExpiresIn').val(),
 			creationTime: new Date().yyyy_mm_ddTHH_mm_ss_sssZ()
 		};
 		db.splice(0, 0, postData);
 		$('#tokenGrid').jsGrid("reset");
-		$('#tokens').val(JSON.stringify(db));
 		$('#tokenDesc').val('');
+		$('#tokenExpiresIn').val('');
 
 		$.ajax({
 			method: 'POST',
@@ -141,11 +173,12 @@ $(document).ready(function () {
 			$("#clipboard").val(postData.accessToken);
 		})
 	});
-});
 
-function saveState(db) {
-	$('#tokens').val(JSON.stringify(db));
-}
+	$('#moreTokens').click(function() {
+		loadTokens(nextCursor);
+	});
+	loadTokens();
+});
 
 Math.guid = function () {
 	// return 'xxxxxxxxxxxx0xxxyxyxxxxxxxxxxxxx'.replace(/[xy]/g, function (c) {
@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+
+import threading
+import time
+
+from contextlib import contextmanager
+
+__all__ = ['Metrics']
+
+# Upper bounds of the latency histogram buckets, in seconds
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+           1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram(object):
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.count += 1
+        self.sum += value
+
+
+class Metrics(object):
+    """In-process latency histograms per phase and response counters per
+    status, rendered in the Prometheus text format.
+    """
+
+    prefix = 'tracaccesstoken'
+
+    def __init__(self):
+        self._histograms = {}  # {phase: Histogram}
+        self._statuses = {}  # {status: count}
+        self._lock = threading.Lock()
+
+    def observe(self, phase, seconds):
+        with self._lock:
+            histogram = self._histograms.get(phase)
+            if histogram is None:
+                histogram = self._histograms[phase] = Histogram()
+            histogram.observe(seconds)
+
+    @contextmanager
+    def timer(self, phase, timings=None):
+        """Time the block as `phase`, also adding the duration to the
+        `timings` dictionary when given.
+        """
+        start = time.time()
+        try:
+            yield
+        finally:
+            elapsed = time.time() - start
+            self.observe(phase, elapsed)
+            if timings is not None:
+                timings[phase] = timings.get(phase, 0) + elapsed
+
+    def count_status(self, status):
+        with self._lock:
+            self._statuses[status] = self._statuses.get(status, 0) + 1
+
+    def render(self, extra=()):
+        """Return the metrics in the Prometheus text format. `extra` is a
+        list of `(name, type, help, value)` tuples appended as is.
+        """
+        lines = []
+        name = self.prefix + '_phase_seconds'
+        lines.append('# HELP %s Time spent in each phase of the ticket API.'
+                     % name)
+        lines.append('# TYPE %s histogram' % name)
+        with self._lock:
+            for phase, histogram in sorted(self._histograms.iteritems()):
+                cumulative = 0
+                for bound, count in zip(histogram.buckets, histogram.counts):
+                    cumulative += count
+                    lines.append('%s_bucket{phase="%s",le="%s"} %d'
+                                 % (name, phase, bound, cumulative))
+                lines.append('%s_bucket{phase="%s",le="+Inf"} %d'
+                             % (name, phase, histogram.count))
+                lines.append('%s_sum{phase="%s"} %f'
+                             % (name, phase, histogram.sum))
+                lines.append('%s_count{phase="%s"} %d'
+                             % (name, phase, histogram.count))
+            name = self.prefix + '_responses_total'
+            lines.append('# HELP %s Responses of the ticket API by status.'
+                         % name)
+            lines.append('# TYPE %s counter' % name)
+            for status, count in sorted(self._statuses.iteritems()):
+                lines.append('%s{status="%s"} %d' % (name, status, count))
+        for name, type_, help_, value in extra:
+            name = '%s_%s' % (self.prefix, name)
+            lines.append('# HELP %s %s' % (name, help_))
+            lines.append('# TYPE %s %s' % (name, type_))
+            lines.append('%s %s' % (name, value))
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+
+import cgi
+import os
+import tempfile
+
+from StringIO import StringIO
+
+__all__ = ['MultipartError', 'PartTooLarge', 'parse_multipart']
+
+CHUNK_SIZE = 64 * 1024
+MAX_HEADER_SIZE = 16 * 1024
+MAX_FIELD_SIZE = 1024 * 1024
+
+
+class MultipartError(ValueError):
+    """Raised when a multipart/form-data body is malformed."""
+
+
+class PartTooLarge(MultipartError):
+    """Raised as soon as a part exceeds its maximum size, before the rest of
+    the body is read.
+    """
+
+    def __init__(self, part, max_size):
+        MultipartError.__init__(self, 'Part "%s" exceeds %d bytes'
+                                % (part.filename or part.name, max_size))
+        self.part = part
+        self.max_size = max_size
+
+
+class Part(object):
+    """A part of the body. File parts are spooled to a temporary file, the
+    other fields are kept in memory.
+    """
+
+    def __init__(self, name, filename=None, content_type=None):
+        self.name = name
+        self.filename = filename
+        self.content_type = content_type
+        self.file = tempfile.TemporaryFile() if filename is not None \
+                    else StringIO()
+        self.size = 0
+
+    @property
+    def value(self):
+        self.file.seek(0)
+        return self.file.read()
+
+    def close(self):
+        self.file.close()
+
+
+def parse_multipart(read, length, boundary, max_file_size=None,
+                    max_files=None, chunk_size=CHUNK_SIZE, max_fields=None):
+    """Read the `length` bytes of a multipart/form-data body from `read`, in
+    chunks of `chunk_size` bytes, returning its parts.
+
+    Files larger than `max_file_size` bytes, other fields larger than
+    `MAX_FIELD_SIZE` bytes and bodies with more than `max_files` files or
+    `max_fields` other fields are rejected as soon as the limit is exceeded.
+    """
+    stream = _Stream(read, length, chunk_size)
+    delimiter = '\r\n--' + boundary
+    parts = []
+    try:
+        stream.copy_until(delimiter, _Discard(), None)
+        nfiles = nfields = 0
+        while True:
+            end = stream.take(2)
+            if end == '--':
+                break
+            if end != '\r\n':
+                raise MultipartError('Malformed boundary')
+            headers = stream.read_until('\r\n\r\n', MAX_HEADER_SIZE)
+            part = _make_part(headers)
+            parts.append(part)
+            if part.filename is not None:
+                nfiles += 1
+                if max_files is not None and nfiles > max_files:
+                    raise MultipartError('More than %d files' % max_files)
+                max_size = max_file_size
+            else:
+                nfields += 1
+                if max_fields is not None and nfields > max_fields:
+                    raise MultipartError('More than %d fields' % max_fields)
+                max_size = MAX_FIELD_SIZE
+            part.size = stream.copy_until(delimiter, part.file, max_size,
+                                          part)
+    except:
+        for part in parts:
+            part.close()
+        raise
+    return parts
+
+
+def _make_part(headers):
+    disposition = content_type = None
+    for line in headers.split('\r\n'):
+        name, sep, value = line.partition(':')
+        if not sep:
+            raise MultipartError('Malformed part header')
+        name = name.strip().lower()
+        if name == 'content-disposition':
+            disposition = cgi.parse_header(value.strip())
+        elif name == 'content-type':
+            content_type = value.strip()
+    if disposition is None or disposition[0] != 'form-data' or \
+            'name' not in disposition[1]:
+        raise MultipartError('Missing form-data disposition')
+    options = disposition[1]
+    filename = options.get('filename')
+    if filename is not None:
+        # Some browsers send the full path of the file
+        filename = os.path.basename(filename.replace('\\', '/'))
+        filename = filename.decode('utf-8', 'replace')
+    return Part(options['name'], filename, content_type)
+
+
+class _Discard(object):
+
+    def write(self, data):
+        pass
+
+
+class _Stream(object):
+    """A buffered reader of a body of known length."""
+
+    def __init__(self, read, length, chunk_size):
+        self._read = read
+        self.remaining = length
+        self.chunk_size = chunk_size
+        # The first delimiter is not preceded by a line break
+        self.buf = '\r\n'
+
+    def _fill(self):
+        if self.remaining <= 0:
+            return False
+        data = self._read(min(self.chunk_size, self.remaining))
+        if not data:
+            self.remaining = 0
+            return False
+        self.remaining -= len(data)
+        self.buf += data
+        return True
+
+    def take(self, size):
+        while len(self.buf) < size and self._fill():
+            pass
+        data, self.buf = self.buf[:size], self.buf[size:]
+        return data
+
+    def read_until(self, separator, max_size):
+        while True:
+            index = self.buf.find(separator)
+            if index >= 0:
+                data = self.buf[:index]
+                self.buf = self.buf[index + len(separator):]
+                return data
+            if len(self.buf) > max_size:
+                raise MultipartError('Part headers exceed %d bytes'
+                                     % max_size)
+            if not self._fill():
+                raise MultipartError('Truncated body')
+
+    def copy_until(self, separator, fileobj, max_size, part=None):
+        """Copy the data up to `separator` to `fileobj`, returning its size.
+        The tail of the buffer which may hold the start of the separator is
+        kept until the next chunk is read.
+        """
+        size = 0
+        keep = len(separator) - 1
+        while True:
+            index = self.buf.find(separator)
+            if index >= 0:
+                data = self.buf[:index]
+                self.buf = self.buf[index + len(separator):]
+            elif len(self.buf) > keep:
+                data = self.buf[:-keep]
+                self.buf = self.buf[-keep:]
+            else:
+                data = ''
+            size += len(data)
+            if max_size is not None and size > max_size:
+                raise PartTooLarge(part, max_size)
+            fileobj.write(data)
+            if index >= 0:
+                return size
+            if not self._fill():
+                raise MultipartError('Truncated body')
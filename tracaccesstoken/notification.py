@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+
+import Queue
+import threading
+import time
+
+from trac.ticket.model import Ticket
+from trac.util.text import exception_to_unicode
+
+__all__ = ['NotificationQueue']
+
+
+class NotificationQueue(object):
+    """Send the ticket notifications from a bounded pool of background
+    threads, so that the SMTP latency is kept out of the API responses.
+
+    A failed notification is retried `max_retries` times, waiting
+    `retry_delay` seconds before the first retry and doubling the delay
+    after each attempt.
+    """
+
+    def __init__(self, env, workers=2, maxsize=1000, max_retries=3,
+                 retry_delay=1.0):
+        self.env = env
+        self.log = env.log
+        self.workers = max(1, workers)
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+        self.dropped = 0
+        self._queue = Queue.Queue(maxsize)
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def enqueue(self, ticket_id, newticket=True, modtime=None):
+        """Queue a notification for the ticket, returning `False` when the
+        queue is full and the notification is dropped. `modtime` is the
+        time of the change to notify, for existing tickets.
+        """
+        self._start()
+        try:
+            self._queue.put_nowait((ticket_id, newticket, modtime))
+        except Queue.Full:
+            with self._lock:
+                self.dropped += 1
+            self.log.error("Notification queue is full, dropped the "
+                           "notification of ticket #%s", ticket_id)
+            return False
+        return True
+
+    def stats(self):
+        return {
+            'depth': self._queue.qsize(),
+            'sent': self.sent,
+            'failed': self.failed,
+            'retried': self.retried,
+            'dropped': self.dropped,
+        }
+
+    def _start(self):
+        if len(self._threads) >= self.workers:
+            return
+        with self._lock:
+            while len(self._threads) < self.workers:
+                thread = threading.Thread(
+                    target=self._run,
+                    name='tracaccesstoken-notify-%d' % len(self._threads))
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+
+    def _run(self):
+        while True:
+            ticket_id, newticket, modtime = self._queue.get()
+            try:
+                self._deliver(ticket_id, newticket, modtime)
+            finally:
+                self._queue.task_done()
+
+    def _deliver(self, ticket_id, newticket, modtime):
+        delay = self.retry_delay
+        for attempt in xrange(self.max_retries + 1):
+            try:
+                self._send(ticket_id, newticket, modtime)
+            except Exception, e:
+                if attempt < self.max_retries:
+                    self.log.warn("Failure sending notification of ticket "
+                                  "#%s, retrying in %ss: %s", ticket_id,
+                                  delay, exception_to_unicode(e))
+                    with self._lock:
+                        self.retried += 1
+                    time.sleep(delay)
+                    delay *= 2
+                else:
+                    self.log.error("Failure sending notification of ticket "
+                                   "#%s: %s", ticket_id,
+                                   exception_to_unicode(e, traceback=True))
+                    with self._lock:
+                        self.failed += 1
+            else:
+                with self._lock:
+                    self.sent += 1
+                return
+
+    def _send(self, ticket_id, newticket, modtime):
+        # Imported on first use, it pulls in the e-mail and template modules
+        from trac.ticket.notification import TicketNotifyEmail
+        t = Ticket(self.env, ticket_id)
+        tn = TicketNotifyEmail(self.env)
+        tn.notify(t, newticket=newticket, modtime=modtime)
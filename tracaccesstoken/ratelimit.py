@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+
+import threading
+import time
+
+from tracaccesstoken.util import LRUCache
+
+__all__ = ['RateLimiter']
+
+
+class RateLimiter(object):
+    """Token buckets refilled at `rate` requests per second and holding at
+    most `burst` requests, one bucket per key. The buckets of the least
+    recently seen keys are forgotten beyond `maxsize` keys.
+
+    A `rate` of 0 disables the limiter.
+    """
+
+    def __init__(self, rate, burst=None, maxsize=10000):
+        self.rate = rate
+        self.burst = max(burst or rate, 1)
+        self._buckets = LRUCache(maxsize)  # {key: [tokens, updated]}
+        self._lock = threading.Lock()
+
+    def acquire(self, key):
+        """Take a request from the bucket of `key`, returning 0 when it is
+        allowed or the seconds to wait before it would be.
+        """
+        if self.rate <= 0:
+            return 0
+        now = time.time()
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = [self.burst, now]
+                self._buckets.set(key, bucket)
+            tokens = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+            if tokens >= 1:
+                bucket[0] = tokens - 1
+                return 0
+            bucket[0] = tokens
+            return (1 - tokens) / self.rate
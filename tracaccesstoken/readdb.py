@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+
+import os
+import threading
+import time
+
+from trac.db.api import DatabaseManager, _parse_db_str
+from trac.db.pool import ConnectionPool
+from trac.util.text import exception_to_unicode
+
+__all__ = ['ReadOnlyDatabase']
+
+
+class ReadOnlyDatabase(object):
+    """Run queries on a pool of connections of their own, to a read
+    replica or to the main SQLite database in WAL mode, so that they do not
+    wait behind the write transactions.
+
+    When no connection is available within `timeout` seconds or the query
+    fails, the query runs on the main pool instead, and the read pool is
+    left alone for `retry_delay` seconds.
+    """
+
+    def __init__(self, env, dsn, maxsize=2, timeout=1.0, retry_delay=30):
+        self.env = env
+        self.log = env.log
+        self.dsn = dsn
+        self.maxsize = maxsize
+        self.timeout = timeout
+        self.retry_delay = retry_delay
+        self.queries = 0
+        self.fallbacks = 0
+        self._pool = None
+        self._pool_lock = threading.Lock()
+        self._retry_at = 0
+
+    def query(self, sql, args=()):
+        """Return the rows of the query, from the read pool if possible."""
+        if time.time() >= self._retry_at:
+            try:
+                rows = self._query(sql, args)
+            except Exception as ex:
+                self._retry_at = time.time() + self.retry_delay
+                self.log.warn("Read-only database %s failed, using the main "
+                              "database for %d seconds. %s", self.dsn,
+                              self.retry_delay, exception_to_unicode(ex))
+            else:
+                self.queries += 1
+                return rows
+        self.fallbacks += 1
+        return self.env.db_query(sql, args)
+
+    def stats(self):
+        return {'queries': self.queries, 'fallbacks': self.fallbacks}
+
+    def _query(self, sql, args):
+        if self._pool is None:
+            with self._pool_lock:
+                if self._pool is None:
+                    self._pool = self._create_pool()
+        cnx = self._pool.get_cnx(self.timeout)
+        try:
+            cursor = cnx.cursor()
+            cursor.execute(sql, args)
+            return cursor.fetchall()
+        finally:
+            cnx.close()
+
+    def _create_pool(self):
+        """Create the pool with the connector of the DSN scheme, relative
+        SQLite paths being resolved against the environment like Trac does.
+        """
+        scheme, args = _parse_db_str(self.dsn)
+        candidates = [(priority, connector)
+                      for connector in DatabaseManager(self.env).connectors
+                      for scheme_, priority in connector.get_supported_schemes()
+                      if scheme_ == scheme and priority >= 0]
+        if not candidates:
+            raise ValueError('Unsupported database type "%s"' % scheme)
+        connector = max(candidates, key=lambda c: c[0])[1]
+        if scheme == 'sqlite' and args['path'] != ':memory:' and \
+                not args['path'].startswith('/'):
+            args['path'] = os.path.join(self.env.path,
+                                        args['path'].lstrip('/'))
+        return ConnectionPool(self.maxsize, connector, **args)
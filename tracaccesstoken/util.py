@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+
+import threading
+import time
+
+from collections import OrderedDict
+
+__all__ = ['LRUCache', 'PeriodicTask']
+
+
+class LRUCache(object):
+    """A thread-safe cache bounded in size, evicting the least recently
+    used entries first. Entries older than `ttl` seconds are dropped on
+    access, a `ttl` of 0 keeps them until evicted.
+    """
+
+    def __init__(self, maxsize, ttl=0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()  # {key: (expires, value)}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.pop(key, None)
+            if entry is None or (entry[0] and entry[0] < time.time()):
+                self.misses += 1
+                return default
+            self._data[key] = entry
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value):
+        if self.maxsize <= 0:
+            return
+        expires = time.time() + self.ttl if self.ttl > 0 else 0
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (expires, value)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def discard(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        return {
+            'size': len(self._data),
+            'maxsize': self.maxsize,
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+
+
+class PeriodicTask(object):
+    """Call `func` every `interval` seconds from a daemon thread, started
+    on the first call to `start()`.
+    """
+
+    def __init__(self, interval, func, name=None, log=None):
+        self.interval = interval
+        self.func = func
+        self.name = name
+        self.log = log
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        if self._thread is not None or self.interval <= 0:
+            return
+        with self._lock:
+            if self._thread is None:
+                thread = threading.Thread(target=self._run, name=self.name)
+                thread.daemon = True
+                thread.start()
+                self._thread = thread
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.func()
+            except Exception:
+                if self.log:
+                    self.log.exception("Periodic task %s failed", self.name)
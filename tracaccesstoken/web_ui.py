@@ -8,88 +8,37 @@ This module defines a Trac extension point for generating access tokens backend.
 See TracTracAccessTokenBackend for more details.
 """
 
-import itertools
-from operator import itemgetter
+import hashlib
 import pkg_resources
-import re
+from datetime import timedelta
 
 try:
     import simplejson as json
 except ImportError:
     import json
 
-from trac.perm import IPermissionRequestor
-from trac.ticket.api import ITicketChangeListener
-from trac.web.chrome import INavigationContributor
 from trac.web.chrome import ITemplateProvider
-from trac.web.main import IRequestHandler
 from trac.prefs import IPreferencePanelProvider
 
-from genshi.builder import tag, Element
 from trac.core import Component
 from trac.core import ExtensionPoint
 from trac.core import implements
-from trac.mimeview import Context
-from trac.perm import PermissionSystem
 from trac.perm import IPermissionGroupProvider
-from trac.util.html import html
-from trac.util.presentation import Paginator
 from trac.util.translation import _
-from trac.web.chrome import add_stylesheet, add_warning, add_script, add_notice
-from trac.wiki.formatter import extract_link
-from trac.util.datefmt import to_utimestamp, datetime_now, utc
-
-import operator
-import hashlib
-import pprint
+from trac.web.api import HTTPBadRequest
+from trac.web.chrome import add_stylesheet, add_script, add_notice
+from trac.util import as_int
+from trac.util.datefmt import (
+    format_datetime, from_utimestamp, to_utimestamp, datetime_now, utc
+)
+from tracaccesstoken.api import TicketAPI
+from tracaccesstoken.constants import CONFIG_FIELD
 
 PACKAGE = 'tracaccesstoken'
-CONFIG_SECTION_NAME = 'access_token_plugin'
-CONFIG_FIELD = {
-    'menu_label': (
-        CONFIG_SECTION_NAME,
-        'menu_label',
-        'Access Tokens',
-    ),
-    'ticket_status': (
-        CONFIG_SECTION_NAME,
-        'ticket_status',
-        'new, accepted, assigned, reopened, closed',
-    ),
-    'ticket_status_enable': (
-        CONFIG_SECTION_NAME,
-        'ticket_status_enable',
-        'new, accepted, assigned, reopened, closed',
-    ),
-    'insensitive_group': (
-        CONFIG_SECTION_NAME,
-        'insensitive_group',
-        'intern,outsourcing',
-    ),
-    'sensitive_keyword': (
-        CONFIG_SECTION_NAME,
-        'isensitive_keyword',
-        'secret',
-    ),
-}
-# --- any() from Python 2.5 ---
-try:
-    from __builtin__ import any
-except ImportError:
-    def any(items):
-        for item in items:
-            if item:
-                return True
-        return False
-
-# ---all() from Python 2.5 ---
-try:
-    from __builtin__ import all
-except ImportError:
-    def all(items):
-        return reduce(operator.__and__, items)
+TOKENS_PAGE_SIZE = 50
+TOKENS_PAGE_MAX_SIZE = 500
 
-__all__ = ("any", "all")
+__all__ = ['AccessTokenBackendException', 'AccessTokenBackendPlugin']
 
 
 def _get_config_values(config, option_name):
@@ -164,13 +113,19 @@ class AccessTokenBackendPlugin(Component):
                         for t in tokens:
                             db(
                                 "INSERT INTO kkbox_trac_access_token ("
-                                "username, access_token, description, change_time, create_time) "
-                                "VALUES (%s,%s,%s,%s,%s)",
+                                "username, access_token, description, change_time, create_time, "
+                                "expire_time) "
+                                "VALUES (%s,%s,%s,%s,%s,%s)",
                                 (req.perm.username,
                                  hashlib.sha224(t['accessToken']).hexdigest(),
                                  t['description'],
-                                 datetime_now(utc),
-                                 datetime_now(utc)))
+                                 to_utimestamp(datetime_now(utc)),
+                                 to_utimestamp(datetime_now(utc)),
+                                 self._expire_time(t.get('expiresIn'))))
+                    api = TicketAPI(self.env)
+                    for t in tokens:
+                        api.forget_rejected_token(
+                            hashlib.sha224(t['accessToken']).hexdigest())
                     self.env.log.info("New access token for %s", req.perm.username)
                     add_notice(req, _('Your access tokens have been saved.'))
             else:
@@ -179,6 +134,7 @@ class AccessTokenBackendPlugin(Component):
                 new_token = {
                     'accessToken': req.args.get('accessToken'),
                     'description': req.args.get('description'),
+                    'expiresIn': req.args.get('expiresIn'),
                 }
                 if new_token:
                     with self.env.db_transaction as db:
@@ -186,13 +142,17 @@ class AccessTokenBackendPlugin(Component):
                         t = new_token
                         db(
                             "INSERT INTO kkbox_trac_access_token ("
-                            "username, access_token, description, change_time, create_time) "
-                            "VALUES (%s,%s,%s,%s,%s)",
+                            "username, access_token, description, change_time, create_time, "
+                            "expire_time) "
+                            "VALUES (%s,%s,%s,%s,%s,%s)",
                             (req.perm.username,
                              hashlib.sha224(t['accessToken']).hexdigest(),
                              t['description'],
-                             datetime_now(utc),
-                             datetime_now(utc)))
+                             to_utimestamp(datetime_now(utc)),
+                             to_utimestamp(datetime_now(utc)),
+                             self._expire_time(t['expiresIn'])))
+                    TicketAPI(self.env).forget_rejected_token(
+                        hashlib.sha224(t['accessToken']).hexdigest())
                     self.env.log.info("New access token for %s at %s" %
                                       (req.perm.username, datetime_now(utc)))
         elif action == 'DELETE':
@@ -200,6 +160,7 @@ class AccessTokenBackendPlugin(Component):
                 with self.env.db_transaction as db:
                     db("""DELETE FROM kkbox_trac_access_token
                           WHERE id=%s""", (token_id,))
+                TicketAPI(self.env).invalidate_token_cache()
                 self.env.log.info("Delete access token id=%s", token_id)
 
         elif action == 'PUT':
@@ -210,27 +171,79 @@ class AccessTokenBackendPlugin(Component):
                     db("""UPDATE kkbox_trac_access_token
                           SET description=%s,
                               change_time=%s
-                          WHERE id=%s""", (body, change_time, token_id, ))
+                          WHERE id=%s""", (body, to_utimestamp(change_time),
+                                            token_id, ))
                     self.env.log.info("Update access token for %s id=%s at %s" %
                                       (req.perm.username, token_id, change_time))
-        else:
-            def _from_database(id_, access_token, description_, create_time):
-                return {
-                    'id': id_,
-                    'accessToken': access_token,
-                    'description': description_,
-                    'creationTime': create_time
-                }
+                TicketAPI(self.env).invalidate_token_cache()
+        elif action == 'GET':
+            self._send_tokens_page(req)
+        return 'prefs_tokens.html', {}
 
-            for row in self.env.db_query("""
-                SELECT id AS id_, access_token, description, create_time
+    def _send_tokens_page(self, req):
+        """Send a page of the user tokens as JSON, newest first.
+
+        The page starts after the `after` cursor returned as `next` by the
+        previous page, and holds at most `limit` tokens.
+        """
+        limit = as_int(req.args.get('limit'), TOKENS_PAGE_SIZE,
+                       min=1, max=TOKENS_PAGE_MAX_SIZE)
+        after = req.args.get('after')
+        where = "username=%s"
+        args = [req.perm.username]
+        if after:
+            try:
+                create_time, id_ = [long(v) for v in after.split(':')]
+            except ValueError:
+                raise HTTPBadRequest(_("Invalid cursor %(cursor)s",
+                                       cursor=after))
+            where += " AND (create_time<%s OR (create_time=%s AND id<%s))"
+            args += [create_time, create_time, id_]
+
+        tokens = []
+        next_cursor = None
+        for id_, access_token, description, create_time, last_use_time, \
+                use_count, expire_time in TicketAPI(self.env).read_query("""
+                SELECT id, access_token, description, create_time,
+                       last_use_time, use_count, expire_time
                 FROM kkbox_trac_access_token
-                WHERE username=%s
-                ORDER BY create_time DESC
-                """, (req.perm.username,)):
-                new_token.append(_from_database(*row))
-            new_token = json.dumps(new_token)
-            self.env.log.info("New access token for %s", new_token)
-        return 'prefs_tokens.html', {
-            'tokens': new_token
-        }
+                WHERE %s
+                ORDER BY create_time DESC, id DESC
+                LIMIT %d
+                """ % (where, limit + 1), args):
+            if len(tokens) == limit:
+                last = tokens[-1]
+                next_cursor = '%s:%s' % (last_create_time, last['id'])
+                break
+            tokens.append({
+                'id': id_,
+                'accessToken': access_token,
+                'description': description,
+                'creationTime': self._format_time(req, create_time),
+                'lastUseTime': self._format_time(req, last_use_time),
+                'useCount': use_count or 0,
+                'expireTime': self._format_time(req, expire_time)
+            })
+            last_create_time = create_time
+        req.send(json.dumps({'tokens': tokens, 'next': next_cursor}),
+                 'application/json')
+
+    def _expire_time(self, expires_in=None):
+        """Return the expiry time of a token created now, living for
+        `expires_in` days or `token_lifetime` days by default. A positive
+        `token_lifetime` is also the maximum lifetime. `None` is returned
+        for tokens which never expire.
+        """
+        days = as_int(expires_in, None, min=0)
+        lifetime = self.config.getint(*CONFIG_FIELD['token_lifetime'])
+        if lifetime > 0:
+            days = min(days, lifetime) if days else lifetime
+        if not days:
+            return None
+        return to_utimestamp(datetime_now(utc) + timedelta(days=days))
+
+    @staticmethod
+    def _format_time(req, t):
+        if not t:
+            return ''
+        return format_datetime(from_utimestamp(t), 'iso8601', req.tz)